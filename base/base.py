@@ -65,43 +65,49 @@ class ProtocolHandler(object):
     # 协议处理程序的类，实现Redis协议
     def __init__(self):
         self.handlers = {
-            '+': self.handle_simple_string,
-            '-': self.handle_error,
-            ':': self.handle_integer,
-            '$': self.handle_string,
-            '*': self.handle_array,
-            '%': self.handle_dict
+            b'+': self.handle_simple_string,
+            b'-': self.handle_error,
+            b':': self.handle_integer,
+            b'$': self.handle_string,
+            b'^': self.handle_unicode,
+            b'*': self.handle_array,
+            b'%': self.handle_dict,
+            b'&': self.handle_set
         }
 
     # 简单的字符串数据
     def handle_simple_string(self, socket_file):
-        return socket_file.readline().rstrip('\r\n')
+        return socket_file.readline().rstrip(b'\r\n')
 
     # 错误信息
     def handle_error(self, socket_file):
-        return Error(socket_file.readline().rstrip('\r\n'))
+        return Error(socket_file.readline().rstrip(b'\r\n'))
 
     # 整数类型数据
     def handle_integer(self, socket_file):
-        return int(socket_file.readline().rstrip('\r\n'))
+        return int(socket_file.readline().rstrip(b'\r\n'))
 
     # 字符串数据
     def handle_string(self, socket_file):
         # 首先读取长度（$<length>\r\n）
-        length = int(socket_file.readline().rstrip('\r\n'))
+        length = int(socket_file.readline().rstrip(b'\r\n'))
         if length == -1:
             return None
         length += 2  # 将尾部\r\n包括在计数中
         return socket_file.read(length)[:-2]
 
+    # UTF-8字符串数据，客户端发送的str参数使用此类型
+    def handle_unicode(self, socket_file):
+        return self.handle_string(socket_file).decode('utf-8')
+
     # 数组类型数据
     def handle_array(self, socket_file):
-        num_elements = int(socket_file.readline().rstrip('\r\n'))
+        num_elements = int(socket_file.readline().rstrip(b'\r\n'))
         return [self.handle_request(socket_file) for _ in range(num_elements)]
 
     # 字典类型数据
     def handle_dict(self, socket_file):
-        num_items = int(socket_file.readline().rstrip('\r\n'))
+        num_items = int(socket_file.readline().rstrip(b'\r\n'))
         elements = [self.handle_request(socket_file)
                     for _ in range(num_items * 2)]
         return dict(zip(elements[::2], elements[1::2]))
@@ -128,7 +134,7 @@ class ProtocolHandler(object):
         self._write(buf, data)
         buf.seek(0)
         socket_file.write(buf.getvalue())
-        socket_file.flusth()
+        socket_file.flush()
 
     # 将Python对象转换为它们的序列化对应项
     def _write(self, buf, data):
@@ -217,13 +223,11 @@ class Server(object):
         while True:
             try:
                 data = self._protocol.handle_request(socket_file)
+                resp = self.get_response(data)
             except Disconnect:
                 break
-
-            try:
-                resp = self.get_response(data)
             except CommandError as exc:
-                resp = Error(exc.args[0])
+                resp = Error(exc.message)
 
             self._protocol.write_response(socket_file, resp)
 
@@ -238,7 +242,8 @@ class Server(object):
         if not data:
             raise CommandError('Missing command')
 
-        command = data[0].upper()
+        # 命令名可能是bytes或str，统一转换为str再查找
+        command = decode(data[0]).upper()
         if command not in self._commands:
             raise CommandError('Unrecognized command: %s' % command)
 
@@ -266,7 +271,7 @@ class Server(object):
         return [self._kv.get(key) for key in keys]
 
     def mset(self, *items):
-        data = zip(items[::2], items[1::2])
+        data = list(zip(items[::2], items[1::2]))
         for key, value in data:
             self._kv[key] = value
         return len(data)
@@ -289,6 +294,10 @@ class Client(object):
             raise CommandError(resp.message)
         return resp
 
+    # 返回一个管道对象，用于把多个命令合并成一次网络往返
+    def pipeline(self):
+        return Pipeline(self)
+
     def get(self, key):
         return self.execute('GET', key)
 
@@ -308,6 +317,48 @@ class Client(object):
         return self.execute('MSET', *items)
 
 
+# 管道：缓存命令，一次性写入所有请求，再依次读取所有响应
+class Pipeline(Client):
+    def __init__(self, client):
+        self._protocol = client._protocol
+        self._socket = client._socket
+        self._fh = client._fh
+        self._queue = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # 正常退出with语句块时自动发送，出现异常则丢弃已缓存的命令
+        if exc_type is None and self._queue:
+            self.send()
+        else:
+            self._queue = []
+
+    # 命令方法都会调用execute，这里只把命令放入队列
+    def execute(self, *args):
+        self._queue.append(args)
+        return self
+
+    def send(self):
+        commands, self._queue = self._queue, []
+        buf = BytesIO()
+        for args in commands:
+            self._protocol._write(buf, args)
+        self._fh.write(buf.getvalue())
+        self._fh.flush()
+
+        # 单个命令的错误以CommandError对象的形式放在结果列表中，不影响其他命令
+        self.results = []
+        for _ in commands:
+            resp = self._protocol.handle_request(self._fh)
+            if isinstance(resp, Error):
+                resp = CommandError(resp.message)
+            self.results.append(resp)
+        return self.results
+
+
 if __name__ == '__main__':
     from gevent import monkey; monkey.patch_all()
     Server().run()
@@ -0,0 +1,105 @@
+import datetime
+from io import BytesIO
+import socket
+import unittest
+
+from base import Client
+from base import CommandError
+from base import Error
+from base import ProtocolHandler
+from base import Server
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TestProtocolHandler(unittest.TestCase):
+    def round_trip(self, data):
+        protocol = ProtocolHandler()
+        buf = BytesIO()
+        protocol._write(buf, data)
+        buf.seek(0)
+        value = protocol.handle_request(buf)
+        self.assertEqual(buf.read(), b'')
+        return value
+
+    def test_round_trip(self):
+        for data in (b'', b'bytes\r\nwith CRLF', u'\u2603 text', 0, -7,
+                     1 << 40, None, [], [b'a', [u'b', 1, None]],
+                     {b'k': b'v', u'u': [1, 2]}, set([b'a', b'b'])):
+            self.assertEqual(self.round_trip(data), data)
+            self.assertEqual(type(self.round_trip(data)), type(data))
+
+    def test_converted_types(self):
+        self.assertEqual(self.round_trip(True), 1)
+        self.assertEqual(self.round_trip(False), 0)
+        self.assertEqual(self.round_trip((b'a', 1)), [b'a', 1])
+        self.assertEqual(self.round_trip(Error('failed')), Error(b'failed'))
+        self.assertEqual(
+            self.round_trip(datetime.datetime(2020, 1, 2, 3, 4, 5)),
+            u'2020-01-02 03:04:05')
+
+    def test_bad_request(self):
+        protocol = ProtocolHandler()
+        self.assertRaises(CommandError, protocol.handle_request,
+                          BytesIO(b'!oops\r\n'))
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        port = free_port()
+        self.server = Server(port=port)
+        self.server._server.start()
+        self.client = Client(port=port)
+
+    def tearDown(self):
+        self.client._socket.close()
+        self.server._server.stop()
+
+    def test_commands(self):
+        client = self.client
+        self.assertEqual(client.set('k', 'v'), 1)
+        self.assertEqual(client.execute(b'SET', b'b', b'bytes'), 1)
+        self.assertEqual(client.execute(b'get', 'k'), 'v')
+        self.assertEqual(client.mset('k1', 'v1', 'k2', 'v2'), 2)
+        self.assertEqual(client.mget('k1', 'k2', 'k3'), ['v1', 'v2', None])
+        self.assertEqual(client.get(b'b'), b'bytes')
+        self.assertEqual(client.delete('k'), 1)
+        self.assertEqual(client.flush(), 3)
+
+        with self.assertRaises(CommandError) as ctx:
+            client.execute('BOGUS')
+        self.assertEqual(ctx.exception.message,
+                         b'Unrecognized command: BOGUS')
+
+    def test_pipeline(self):
+        # A failing command is reported in the results, and does not stop
+        # the others.
+        with self.client.pipeline() as pipe:
+            pipe.set('a', '1')
+            pipe.execute('BOGUS')
+            pipe.mset('b', '2', 'c', '3')
+            pipe.mget('a', 'b', 'c')
+        self.assertEqual(len(pipe.results), 4)
+        self.assertEqual(pipe.results[0], 1)
+        self.assertTrue(isinstance(pipe.results[1], CommandError))
+        self.assertEqual(pipe.results[1].message,
+                         b'Unrecognized command: BOGUS')
+        self.assertEqual(pipe.results[2:], [2, ['1', '2', '3']])
+        self.assertEqual(self.client.get('c'), '3')
+
+        # Commands are discarded if the block raises.
+        with self.assertRaises(ValueError):
+            with self.client.pipeline() as pipe:
+                pipe.set('d', '4')
+                raise ValueError()
+        self.assertEqual(self.client.get('d'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the simpledb server internals.
+
+Usage: python benchmark.py [-n ITERATIONS] [benchmark ...]
+"""
+from collections import deque
+from io import BytesIO
+import datetime
+import multiprocessing
+import optparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+from simpledb import Error
+from simpledb import ProtocolHandler
+from simpledb import QueueServer
+from simpledb import RequestParser
+from simpledb import ResponseBuffer
+from simpledb import encode
+from simpledb import unicode
+
+
+_benchmarks = []
+
+
+def benchmark(fn):
+    _benchmarks.append(fn)
+    return fn
+
+
+def timed(fn, *args, **kwargs):
+    # Best of several runs, to smooth out noise from the rest of the system.
+    best = None
+    for _ in range(kwargs.pop('repeat', 3)):
+        start = time.time()
+        fn(*args)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def report(name, baseline, duration, count):
+    print('  %-28s %10.1f ops/s  %6.2fx' % (
+        name, count / duration, baseline / duration))
+
+
+def encode_requests(requests):
+    protocol = ProtocolHandler()
+    buf = BytesIO()
+    for request in requests:
+        protocol._write(buf, request)
+    return buf.getvalue()
+
+
+def parser_workloads(n):
+    small = []
+    for i in range(n):
+        key = b'key-%d' % i
+        small.append([b'SET', key, b'value-%d' % i])
+        small.append([b'GET', key])
+        small.append([b'INCRBY', b'counter', i])
+
+    mset = [[b'MSET', dict((b'k%d' % i, b'v%d' % i) for i in range(1000))]
+            for _ in range(max(n // 100, 1))]
+    large = [[b'SET', b'big-%d' % i, b'x' * (1024 * 1024)]
+             for i in range(max(n // 1000, 1))]
+
+    mixed = []
+    for request in small[:n]:
+        mixed.append(request)
+    mixed.extend(mset[:10])
+    mixed.extend(large[:2])
+    return (
+        ('small commands', small),
+        ('MSET 1000 keys', mset),
+        ('1MB values', large),
+        ('mixed', mixed))
+
+
+def send_in_background(data):
+    reader, writer = socket.socketpair()
+    thread = threading.Thread(target=writer.sendall, args=(data,))
+    thread.daemon = True
+    thread.start()
+    return reader, writer
+
+
+def parse_with_handler(data, count):
+    protocol = ProtocolHandler()
+    reader, writer = send_in_background(data)
+    socket_file = reader.makefile('rb')
+    for _ in range(count):
+        protocol.handle_request(socket_file)
+    socket_file.close()
+    reader.close()
+    writer.close()
+
+
+def parse_with_parser(data, count, read_size=65536):
+    parser = RequestParser()
+    reader, writer = send_in_background(data)
+    chunk = bytearray(read_size)
+    view = memoryview(chunk)
+    parsed = 0
+    while parsed < count:
+        target = parser.get_buffer()
+        if target is not None:
+            parser.buffer_updated(reader.recv_into(target))
+        else:
+            parser.feed(view[:reader.recv_into(chunk)])
+        while parser.gets() is not False:
+            parsed += 1
+    reader.close()
+    writer.close()
+
+
+@benchmark
+def parser(n):
+    for name, requests in parser_workloads(n):
+        data = encode_requests(requests)
+        count = len(requests)
+        print('%s (%d requests, %d bytes)' % (name, count, len(data)))
+        baseline = timed(parse_with_handler, data, count)
+        report('ProtocolHandler', baseline, baseline, count)
+        report('RequestParser', baseline,
+               timed(parse_with_parser, data, count), count)
+
+
+class FormattingProtocolHandler(ProtocolHandler):
+    # _write() as it was before the shared reply table was introduced.
+    def _write(self, buf, data):
+        if isinstance(data, bytes):
+            self._write_bulk(buf, b'$', data)
+        elif isinstance(data, (bytearray, memoryview)):
+            self._write_bulk(buf, b'$', data)
+        elif isinstance(data, unicode):
+            self._write_bulk(buf, b'^', data.encode('utf-8'))
+        elif data is True or data is False:
+            buf.write(b':%d\r\n' % (1 if data else 0))
+        elif isinstance(data, (int, float)):
+            buf.write(b':%d\r\n' % data)
+        elif isinstance(data, Error):
+            buf.write(b'-%s\r\n' % encode(data.message))
+        elif isinstance(data, (list, tuple, deque)):
+            buf.write(b'*%d\r\n' % len(data))
+            for item in data:
+                self._write(buf, item)
+        elif isinstance(data, dict):
+            buf.write(b'%%%d\r\n' % len(data))
+            for key in data:
+                self._write(buf, key)
+                self._write(buf, data[key])
+        elif isinstance(data, set):
+            buf.write(b'&%d\r\n' % len(data))
+            for item in data:
+                self._write(buf, item)
+        elif data is None:
+            buf.write(b'$-1\r\n')
+        elif isinstance(data, datetime.datetime):
+            self._write(buf, str(data))
+
+
+def write_replies(protocol, replies):
+    buf = ResponseBuffer()
+    for reply in replies:
+        protocol._write(buf, reply)
+    return buf.getvalue()
+
+
+@benchmark
+def replies(n):
+    workloads = (
+        ('SET/DELETE (1, 0)', [1, 0] * n),
+        ('misses (None)', [None] * n),
+        ('counters (0..10000)', [i % 10001 for i in range(n)]),
+        ('empty results ([])', [[]] * n),
+        ('mixed', [1, None, 0, 1, [], 42, True, -1] * (n // 8)))
+    for name, data in workloads:
+        count = len(data)
+        assert (write_replies(FormattingProtocolHandler(), data) ==
+                write_replies(ProtocolHandler(), data))
+        print('%s (%d replies)' % (name, count))
+        baseline = timed(write_replies, FormattingProtocolHandler(), data)
+        report('format per reply', baseline, baseline, count)
+        duration = timed(write_replies, ProtocolHandler(), data)
+        report('shared replies', baseline, duration, count)
+        print('  %-28s %10.1f ns/reply' % (
+            'saved', (baseline - duration) * 1e9 / count))
+
+
+def run_requests(server, requests):
+    server.run_requests(requests)
+
+
+@benchmark
+def clock(n):
+    # The asyncio backend runs commands inline, so this measures the
+    # commands rather than the hand-off to the thread-mode executor.
+    servers = [
+        ('time() per check', QueueServer(use_asyncio=True, hz=0,
+                                         strict_clock=True)),
+        ('cached clock', QueueServer(use_asyncio=True, hz=0))]
+    keys = [b'key-%d' % i for i in range(500)]
+    for _, server in servers:
+        for key in keys:
+            server.kv_set(key, b'value')
+            server.expire(key, 3600)
+
+    batches = max(n // 100, 1)
+    workloads = (
+        ('MGET 500 keys', [[b'MGET'] + keys] * batches),
+        ('MGET 10 keys', [[b'MGET'] + keys[:10]] * (batches * 50)),
+        ('GET', [[b'GET', key] for key in keys] * batches))
+    for name, requests in workloads:
+        count = len(requests)
+        print('%s (%d requests, keys with a TTL)' % (name, count))
+        baseline = None
+        for label, server in servers:
+            duration = timed(run_requests, server, requests)
+            baseline = baseline or duration
+            report(label, baseline, duration, count)
+
+
+def restore_snapshot(filename, lazy=False):
+    QueueServer(use_asyncio=True, hz=0).restore_from_disk(filename, lazy=lazy)
+
+
+@benchmark
+def restore(n):
+    # n * 100 keys: 1M keys by default, 10M with -n 100000.
+    count = n * 100
+    cpus = multiprocessing.cpu_count()
+    partitions = max(cpus, 2)
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirname, 'snapshot')
+        print('%d keys, %d partitions, %d CPUs' % (count, partitions, cpus))
+        server = QueueServer(use_asyncio=True, hz=0)
+        for start in range(0, count, 10000):
+            server.kv_mset(dict((b'key-%d' % i, b'value-%d' % i)
+                                for i in range(start, start + 10000)))
+
+        server.write_snapshot(filename)
+        baseline = timed(restore_snapshot, filename, repeat=1)
+        report('single file', baseline, baseline, count)
+        report('lazy', baseline,
+               timed(restore_snapshot, filename, True, repeat=1), count)
+
+        server._partitions = partitions
+        server.write_snapshot(filename)
+        report('%d partitions' % partitions, baseline,
+               timed(restore_snapshot, filename, repeat=1), count)
+    finally:
+        shutil.rmtree(dirname)
+
+
+def get_option_parser():
+    parser = optparse.OptionParser(usage='%prog [options] [benchmark ...]')
+    parser.add_option('-n', '--iterations', default=10000, dest='iterations',
+                      help='Workload size.', type=int)
+    return parser
+
+
+if __name__ == '__main__':
+    options, args = get_option_parser().parse_args()
+    available = dict((fn.__name__, fn) for fn in _benchmarks)
+    for name in args:
+        if name not in available:
+            sys.stderr.write('Unknown benchmark "%s". Choose from: %s\n' %
+                             (name, ', '.join(sorted(available))))
+            sys.exit(1)
+    for fn in _benchmarks:
+        if not args or fn.__name__ in args:
+            print('\x1b[1m%s\x1b[0m' % fn.__name__)
+            fn(options.iterations)
@@ -4,29 +4,44 @@ try:
     import gevent
     from gevent import socket
     from gevent.pool import Pool
+    from gevent.queue import Queue as GreenletQueue
     from gevent.server import StreamServer
     from gevent.thread import get_ident
     HAVE_GEVENT = True
 except ImportError:
     import socket
-    Pool = StreamServer = None
+    GreenletQueue = Pool = StreamServer = None
     HAVE_GEVENT = False
 
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
 from collections import deque
 from collections import namedtuple
+from functools import partial
 from functools import wraps
 from io import BytesIO
+from itertools import repeat
 from socket import error as socket_error
 import datetime
 import heapq
 import importlib
 import json
 import logging
+import mmap
+import multiprocessing
+import operator
 import optparse
 import os
-import pickle
+import re
+import struct
 import sys
+import tempfile
+import threading
 import time
+import uuid
+import zlib
 try:
     from threading import get_ident as get_ident_t
 except ImportError:
@@ -35,20 +50,37 @@ try:
     import socketserver as ss
 except ImportError:
     import SocketServer as ss
+try:
+    from concurrent.futures import Future
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    Future = ProcessPoolExecutor = None
+try:
+    from queue import SimpleQueue
+except ImportError:
+    try:
+        from queue import Queue as SimpleQueue
+    except ImportError:
+        from Queue import Queue as SimpleQueue
 
 
 __version__ = '0.4.3'
 
+# Atomic rename that also replaces an existing file on Windows.
+rename = getattr(os, 'replace', os.rename)
+
 logger = logging.getLogger(__name__)
 
 
 class ThreadedStreamServer(object):
-    def __init__(self, address, handler):
+    def __init__(self, address, handler, reuse_port=False):
         self.address = address
         self.handler = handler
+        self.reuse_port = reuse_port
 
-    def serve_forever(self):
+    def _create_server(self):
         handler = self.handler
+        reuse_port = self.reuse_port
         class RequestHandler(ss.BaseRequestHandler):
             def handle(self):
                 return handler(self.request, self.client_address)
@@ -56,13 +88,206 @@ class ThreadedStreamServer(object):
         class ThreadedServer(ss.ThreadingMixIn, ss.TCPServer):
             allow_reuse_address = True
 
+            def server_bind(self):
+                if reuse_port:
+                    self.socket.setsockopt(socket.SOL_SOCKET,
+                                           socket.SO_REUSEPORT, 1)
+                ss.TCPServer.server_bind(self)
+
         self.stream_server = ThreadedServer(self.address, RequestHandler)
+
+    def start(self):
+        self._create_server()
+        thread = threading.Thread(target=self.stream_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def serve_forever(self):
+        self._create_server()
         self.stream_server.serve_forever()
 
     def stop(self):
         self.stream_server.shutdown()
 
 
+class AsyncioStreamServer(object):
+    """
+    Serves connections from an asyncio event loop, using one protocol instance
+    per connection. `loop_factory` can be used to run on an alternative loop
+    implementation, e.g. uvloop.new_event_loop.
+    """
+    def __init__(self, address, protocol_factory, loop_factory=None,
+                 reuse_port=False):
+        if asyncio is None:
+            raise Exception('asyncio is not available on this version of '
+                            'Python.')
+        self.address = address
+        self.protocol_factory = protocol_factory
+        self.loop_factory = loop_factory or asyncio.new_event_loop
+        self.reuse_port = reuse_port
+        self.loop = None
+        self._periodic = []
+        self._started = threading.Event()
+
+    def call_periodically(self, interval, callback):
+        self._periodic.append((interval, callback))
+
+    def _schedule(self, interval, callback):
+        def run():
+            callback()
+            self.loop.call_later(interval, run)
+        self.loop.call_later(interval, run)
+
+    def serve_forever(self):
+        self.loop = loop = self.loop_factory()
+        asyncio.set_event_loop(loop)
+        host, port = self.address
+        server = loop.run_until_complete(loop.create_server(
+            self.protocol_factory, host, port, reuse_address=True,
+            reuse_port=self.reuse_port or None))
+        for interval, callback in self._periodic:
+            self._schedule(interval, callback)
+        self._started.set()
+        try:
+            loop.run_forever()
+        finally:
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+            loop.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def call_threadsafe(self, fn, *args):
+        # Run fn on the event loop from another thread, and wait for it.
+        self._started.wait()
+        future = Future()
+        def run():
+            try:
+                future.set_result(fn(*args))
+            except BaseException as exc:
+                future.set_exception(exc)
+        self.loop.call_soon_threadsafe(run)
+        return future.result()
+
+
+class AsyncioConnection(asyncio.BufferedProtocol if asyncio else object):
+    def __init__(self, server):
+        self.server = server
+        self.parser = RequestParser()
+        self.chunk = bytearray(server._read_size)
+        self.transport = self.address = None
+        self.replica = None
+        self._reading_target = False
+        self._writable = threading.Event()
+        self._writable.set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.address = transport.get_extra_info('peername')[:2]
+        logger.info('Connection received: %s:%s' % self.address)
+        self.server._active_connections += 1
+
+    def connection_lost(self, exc):
+        self.server._active_connections -= 1
+        self._writable.set()
+        if self.replica is not None:
+            logger.info('Replica went away: %s:%s' % self.address)
+            self.replica.closed = True
+
+    def get_buffer(self, sizehint):
+        target = self.parser.get_buffer()
+        self._reading_target = target is not None
+        return target if self._reading_target else self.chunk
+
+    def buffer_updated(self, nbytes):
+        if self.replica is not None:
+            # Nothing is expected from a replica once it has synced.
+            return
+        elif self._reading_target:
+            self.parser.buffer_updated(nbytes)
+        else:
+            with memoryview(self.chunk) as view:
+                self.parser.feed(view[:nbytes])
+
+        try:
+            self.server.process_requests(self, self.parser)
+        except ClientQuit:
+            logger.info('Client exited: %s:%s.' % self.address)
+            self.transport.close()
+        except ReplicaSync as exc:
+            logger.info('Replica connected: %s:%s' % self.address)
+            self.replica = exc.replica
+            self.replica.attach(self)
+        except CommandError as exc:
+            logger.info('Protocol error from %s:%s: %s' %
+                        (self.address[0], self.address[1], exc.message))
+            self.server._protocol.send_responses(self, [Error(exc.message)])
+            self.transport.close()
+        except Exception as exc:
+            logger.exception('Error processing command.')
+
+    def eof_received(self):
+        logger.info('Client went away: %s:%s' % self.address)
+
+    # Stop reading requests while the client is not reading the responses.
+    def pause_writing(self):
+        self._writable.clear()
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self._writable.set()
+        self.transport.resume_reading()
+
+    def sendall(self, data):
+        self.transport.write(data)
+
+    def sendall_threadsafe(self, data):
+        # Called from another thread: waits until the client has caught up,
+        # then writes from the event loop.
+        self._writable.wait()
+        self.call_threadsafe(self.transport.write, data)
+
+    def call_threadsafe(self, fn, *args):
+        return self.server._server.call_threadsafe(fn, *args)
+
+    def close(self):
+        self.transport.close()
+
+
+class CommandExecutor(object):
+    """
+    Runs functions one at a time on a dedicated thread. Other threads hand
+    work over through a queue and wait for the result on a future, so all
+    access to the server's data happens on a single thread.
+    """
+    def __init__(self):
+        self._queue = SimpleQueue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            future, fn, args = self._queue.get()
+            try:
+                result = fn(*args)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._queue.put((future, fn, args))
+        return future
+
+    def call(self, fn, *args):
+        if get_ident_t() == self._thread.ident:
+            return fn(*args)
+        return self.submit(fn, *args).result()
+
+
 class CommandError(Exception):
     def __init__(self, message):
         self.message = message
@@ -112,6 +337,7 @@ Set: "&number of elements\r\n...elements..."
 if sys.version_info[0] == 3:
     unicode = str
     basestring = (bytes, str)
+    long = int
 
 
 def encode(s):
@@ -132,11 +358,30 @@ def decode(s):
         return str(s)
 
 
+# Filenames arrive from clients as bytes or str, and are used as str.
+fsdecode = getattr(os, 'fsdecode', decode)
+
+
 Error = namedtuple('Error', ('message',))
 
 
+# Pre-encoded replies, shared by every response that needs them. Commands
+# report success with 1, so the integer table doubles as the "OK" reply.
+SHARED_INT_MIN = -1
+SHARED_INT_MAX = 10000
+SHARED_INTEGERS = [b':%d\r\n' % i
+                   for i in range(SHARED_INT_MIN, SHARED_INT_MAX + 1)]
+TRUE_REPLY = SHARED_INTEGERS[1 - SHARED_INT_MIN]
+FALSE_REPLY = SHARED_INTEGERS[0 - SHARED_INT_MIN]
+NULL_REPLY = b'$-1\r\n'
+EMPTY_ARRAY_REPLY = b'*0\r\n'
+EMPTY_DICT_REPLY = b'%0\r\n'
+EMPTY_SET_REPLY = b'&0\r\n'
+
+
 class ProtocolHandler(object):
-    def __init__(self):
+    def __init__(self, zero_copy_threshold=16384):
+        self.zero_copy_threshold = zero_copy_threshold
         self.handlers = {
             b'+': self.handle_simple_string,
             b'-': self.handle_error,
@@ -165,8 +410,15 @@ class ProtocolHandler(object):
         length = int(socket_file.readline().rstrip(b'\r\n'))
         if length == -1:
             return None
-        length += 2
-        return socket_file.read(length)[:-2]
+        # Read the payload and the trailer separately, rather than slicing
+        # the trailer off (and copying the payload) afterwards.
+        data = socket_file.read(length)
+        trailer = socket_file.read(2)
+        if len(data) < length or len(trailer) < 2:
+            raise EOFError()
+        elif trailer != b'\r\n':
+            raise ValueError('Bulk string is not terminated by CRLF.')
+        return data
 
     def handle_unicode(self, socket_file):
         return self.handle_string(socket_file).decode('utf-8')
@@ -205,41 +457,371 @@ class ProtocolHandler(object):
         socket_file.write(buf.getvalue())
         socket_file.flush()
 
+    def write_responses(self, socket_file, responses):
+        buf = BytesIO()
+        for data in responses:
+            self._write(buf, data)
+        socket_file.write(buf.getvalue())
+        socket_file.flush()
+
+    def encode_responses(self, responses):
+        buf = ResponseBuffer(self.zero_copy_threshold)
+        for data in responses:
+            self._write(buf, data)
+        return buf
+
+    def send_responses(self, sock, responses):
+        self.encode_responses(responses).send(sock)
+
     def _write(self, buf, data):
-        if isinstance(data, bytes):
-            buf.write(b'$%d\r\n%s\r\n' % (len(data), data))
+        if type(data) is int and SHARED_INT_MIN <= data <= SHARED_INT_MAX:
+            buf.write(SHARED_INTEGERS[data - SHARED_INT_MIN])
+        elif data is None:
+            buf.write(NULL_REPLY)
+        elif isinstance(data, bytes):
+            self._write_bulk(buf, b'$', data)
+        elif isinstance(data, (bytearray, memoryview)):
+            self._write_bulk(buf, b'$', data)
         elif isinstance(data, unicode):
-            bdata = data.encode('utf-8')
-            buf.write(b'^%d\r\n%s\r\n' % (len(bdata), bdata))
+            self._write_bulk(buf, b'^', data.encode('utf-8'))
         elif data is True or data is False:
-            buf.write(b':%d\r\n' % (1 if data else 0))
+            buf.write(TRUE_REPLY if data else FALSE_REPLY)
         elif isinstance(data, (int, float)):
             buf.write(b':%d\r\n' % data)
         elif isinstance(data, Error):
             buf.write(b'-%s\r\n' % encode(data.message))
         elif isinstance(data, (list, tuple, deque)):
+            if not data:
+                buf.write(EMPTY_ARRAY_REPLY)
+                return
             buf.write(b'*%d\r\n' % len(data))
             for item in data:
                 self._write(buf, item)
         elif isinstance(data, dict):
+            if not data:
+                buf.write(EMPTY_DICT_REPLY)
+                return
             buf.write(b'%%%d\r\n' % len(data))
             for key in data:
                 self._write(buf, key)
                 self._write(buf, data[key])
         elif isinstance(data, set):
+            if not data:
+                buf.write(EMPTY_SET_REPLY)
+                return
             buf.write(b'&%d\r\n' % len(data))
             for item in data:
                 self._write(buf, item)
-        elif data is None:
-            buf.write(b'$-1\r\n')
         elif isinstance(data, datetime.datetime):
             self._write(buf, str(data))
 
+    def _write_bulk(self, buf, prefix, data):
+        if len(data) < self.zero_copy_threshold:
+            buf.write(b'%s%d\r\n%s\r\n' % (prefix, len(data), data))
+        else:
+            # Write large payloads separately instead of formatting them into
+            # a new string, so a ResponseBuffer can send them without a copy.
+            buf.write(b'%s%d\r\n' % (prefix, len(data)))
+            buf.write(data)
+            buf.write(b'\r\n')
+
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class ResponseBuffer(object):
+    """
+    File-like buffer that keeps serialized responses as a list of segments.
+    Small writes are coalesced, while payloads of at least `threshold` bytes
+    are kept as memoryviews of the original object and sent with sendmsg()
+    without ever being copied into a contiguous buffer.
+    """
+    def __init__(self, threshold=16384):
+        self.threshold = threshold
+        self.segments = []
+        self._current = bytearray()
+
+    def write(self, data):
+        if len(data) >= self.threshold:
+            if self._current:
+                self.segments.append(self._current)
+                self._current = bytearray()
+            self.segments.append(memoryview(data))
+        else:
+            self._current += data
+
+    def get_segments(self):
+        if self._current:
+            self.segments.append(self._current)
+            self._current = bytearray()
+        return self.segments
+
+    def getvalue(self):
+        return b''.join(self.get_segments())
+
+    def send(self, sock):
+        segments = self.get_segments()
+        if len(segments) == 1 or not hasattr(sock, 'sendmsg'):
+            for segment in segments:
+                sock.sendall(segment)
+            return
+
+        idx = 0
+        while idx < len(segments):
+            sent = sock.sendmsg(segments[idx:idx + IOV_MAX])
+            # Skip past the fully-sent segments and trim a partial one.
+            while sent:
+                nbytes = len(segments[idx])
+                if sent >= nbytes:
+                    sent -= nbytes
+                    idx += 1
+                else:
+                    segments[idx] = memoryview(segments[idx])[sent:]
+                    sent = 0
+
+
+class RequestParser(object):
+    """
+    Incremental parser for data read from a connection. Chunks are passed in
+    with feed() as they arrive, and gets() returns the next complete value or
+    False if more data is needed. Partially-received aggregates are kept on a
+    stack, and the number of bytes needed to make progress is remembered, so
+    a large request is neither re-parsed nor re-assembled on every read.
+
+    Bulk strings of at least `readinto_threshold` bytes are received into a
+    preallocated bytearray, which is returned as the value. While one is in
+    progress get_buffer() returns the unfilled part of it, so the caller can
+    recv_into() it directly and report the byte count with buffer_updated().
+    Longer bulk strings than `max_bulk_length` are rejected before anything
+    is allocated for them.
+    """
+    def __init__(self, readinto_threshold=65536,
+                 max_bulk_length=512 * 1024 * 1024):
+        self.readinto_threshold = readinto_threshold
+        self.max_bulk_length = max_bulk_length
+        self._data = b''
+        self._pos = 0
+        self._chunks = []
+        self._pending = 0
+        self._need = 0
+        self._stack = []
+        self._target = None
+        self._target_prefix = None
+        self._filled = 0
+
+    def feed(self, data):
+        if self._target is not None:
+            nbytes = min(len(data), len(self._target) - self._filled)
+            with memoryview(self._target) as view:
+                view[self._filled:self._filled + nbytes] = data[:nbytes]
+            self._filled += nbytes
+            data = data[nbytes:]
+            if not len(data):
+                return
+        self._chunks.append(bytes(data))
+        self._pending += len(data)
+
+    def get_buffer(self):
+        if self._target is not None and self._filled < len(self._target):
+            return memoryview(self._target)[self._filled:]
+
+    def buffer_updated(self, nbytes):
+        self._filled += nbytes
+
+    def unparsed(self):
+        # Takes back the data fed in after the last value returned by gets(),
+        # to read what follows some other way.
+        data = self._data[self._pos:] + b''.join(self._chunks)
+        self._data = b''
+        self._pos = self._pending = self._need = 0
+        self._chunks = []
+        return data
+
+    def buffered(self):
+        # Bytes fed in but not yet parsed. Between complete values this is
+        # everything after the last value returned by gets().
+        return len(self._data) - self._pos + self._pending
+
+    def gets(self):
+        if self._target is not None and self._filled < len(self._target):
+            return False
+
+        if self._chunks:
+            available = len(self._data) - self._pos + self._pending
+            if available < self._need:
+                return False
+            if self._pos < len(self._data):
+                self._chunks.insert(0, self._data[self._pos:])
+            self._data = b''.join(self._chunks)
+            self._pos = 0
+            self._chunks = []
+            self._pending = 0
+        self._need = 0
+        if self._target is not None:
+            if len(self._data) - self._pos < 2:
+                self._need = 2
+                return False
+            value = self._attach(self._finish_target())
+            if value is not False:
+                return value
+        return self._parse()
+
+    def _finish_target(self):
+        value, prefix = self._target, self._target_prefix
+        self._target = self._target_prefix = None
+        if self._data[self._pos:self._pos + 2] != b'\r\n':
+            raise CommandError('Protocol error: bad bulk string')
+        self._pos += 2
+        if prefix == _UNICODE:
+            return value.decode('utf-8')
+        elif prefix == _JSON:
+            return json.loads(value)
+        return value
+
+    def _attach(self, value):
+        stack = self._stack
+        while stack:
+            prefix, length, items = stack[-1]
+            items.append(value)
+            if len(items) < length:
+                return False
+            stack.pop()
+            value = _build_aggregate(prefix, items)
+        return value
+
+    def _parse(self):
+        buf = self._data
+        find = buf.find
+        size = len(buf)
+        stack = self._stack
+        pos = self._pos
+        try:
+            while True:
+                end = find(b'\r\n', pos)
+                if end == -1:
+                    self._need = size - pos + 1
+                    return False
+
+                prefix = buf[pos]
+                if prefix == _STRING or prefix == _UNICODE or prefix == _JSON:
+                    length = int(buf[pos + 1:end])
+                    if length > self.max_bulk_length:
+                        raise CommandError('Protocol error: bulk string '
+                                           'too long')
+                    elif length < 0:
+                        value = None
+                        pos = end + 2
+                    else:
+                        start = end + 2
+                        stop = start + length
+                        if stop + 2 > size:
+                            if stop <= size or \
+                                    length < self.readinto_threshold:
+                                self._need = stop + 2 - pos
+                                return False
+                            # Move what has arrived so far into a buffer
+                            # sized for the whole payload, the trailer is
+                            # checked once the payload is complete.
+                            self._target = bytearray(length)
+                            self._target[:size - start] = buf[start:]
+                            self._target_prefix = prefix
+                            self._filled = size - start
+                            pos = size
+                            return False
+                        if buf[stop] != 13 or buf[stop + 1] != 10:
+                            raise CommandError('Protocol error: bad bulk '
+                                               'string')
+                        value = buf[start:stop]
+                        pos = stop + 2
+                        if prefix == _UNICODE:
+                            value = value.decode('utf-8')
+                        elif prefix == _JSON:
+                            value = json.loads(value)
+                elif prefix == _ARRAY or prefix == _DICT or prefix == _SET:
+                    length = int(buf[pos + 1:end])
+                    pos = end + 2
+                    if prefix == _DICT:
+                        length *= 2
+                    items = []
+                    # Fast path for the common case of an aggregate made up
+                    # entirely of bulk strings, e.g. a command and its args.
+                    append = items.append
+                    remaining = length
+                    while remaining > 0 and pos < size and buf[pos] == 36:
+                        end = find(b'\r\n', pos)
+                        if end == -1:
+                            break
+                        start = end + 2
+                        stop = start + int(buf[pos + 1:end])
+                        if stop < start or stop + 2 > size:
+                            break
+                        if buf[stop] != 13 or buf[stop + 1] != 10:
+                            raise CommandError('Protocol error: bad bulk '
+                                               'string')
+                        append(buf[start:stop])
+                        pos = stop + 2
+                        remaining -= 1
+                    if remaining > 0:
+                        stack.append((prefix, length, items))
+                        continue
+                    value = _build_aggregate(prefix, items)
+                else:
+                    if prefix == _SIMPLE_STRING:
+                        value = buf[pos + 1:end]
+                    elif prefix == _ERROR:
+                        value = Error(buf[pos + 1:end])
+                    elif prefix == _INTEGER:
+                        number = buf[pos + 1:end]
+                        value = float(number) if b'.' in number else int(number)
+                    else:
+                        # Inline request, e.g. "GET key\r\n".
+                        value = buf[pos:end]
+                    pos = end + 2
+
+                if stack:
+                    value = self._attach(value)
+                    if value is False:
+                        continue
+                return value
+        except ValueError:
+            raise CommandError('Protocol error: invalid length or integer')
+        finally:
+            self._pos = pos
+
+
+_SIMPLE_STRING, _ERROR, _INTEGER = ord('+'), ord('-'), ord(':')
+_STRING, _UNICODE, _JSON = ord('$'), ord('^'), ord('@')
+_ARRAY, _DICT, _SET = ord('*'), ord('%'), ord('&')
+
+
+def _build_aggregate(prefix, items):
+    # Large bulk strings are received as bytearrays, which cannot be hashed.
+    if prefix == _ARRAY:
+        return items
+    elif prefix == _DICT:
+        keys = [bytes(key) if isinstance(key, bytearray) else key
+                for key in items[::2]]
+        return dict(zip(keys, items[1::2]))
+    return set(bytes(item) if isinstance(item, bytearray) else item
+               for item in items)
+
 
 class ClientQuit(Exception): pass
 class Shutdown(Exception): pass
 
 
+class ReplicaSync(Exception):
+    # Raised by SYNC and PSYNC, to turn the connection into a replication
+    # link once the reply has been sent.
+    def __init__(self, replica, reply):
+        super(ReplicaSync, self).__init__('replica connected')
+        self.replica = replica
+        self.reply = reply
+
+
 class ServerError(Exception): pass
 class ServerDisconnect(ServerError): pass
 class ServerInternalError(ServerError): pass
@@ -247,69 +829,1171 @@ class ServerInternalError(ServerError): pass
 
 Value = namedtuple('Value', ('data_type', 'value'))
 
+CMD_WRITE = 1
+CMD_READONLY = 2
+CMD_ADMIN = 4
+
+_CMD_FLAG_NAMES = (
+    (CMD_WRITE, 'write'),
+    (CMD_READONLY, 'readonly'),
+    (CMD_ADMIN, 'admin'))
+
+
+class Command(namedtuple('Command', ('name', 'callback', 'arity', 'flags',
+                                     'first_key', 'last_key', 'key_step',
+                                     'max_arity'))):
+    """
+    Command table entry. Arity and key positions follow Redis conventions:
+    they count the command name as argument 0, a negative arity means "at
+    least that many", and a negative last_key counts from the end. An arity
+    of None disables argument-count validation. Commands with optional
+    arguments, rather than any number of them, also have a max_arity.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, callback, arity, flags, first_key, last_key,
+                key_step, max_arity=None):
+        return super(Command, cls).__new__(cls, name, callback, arity, flags,
+                                           first_key, last_key, key_step,
+                                           max_arity)
+
+    def check_arity(self, argv):
+        if self.arity is None:
+            return True
+        elif self.arity >= 0:
+            return len(argv) == self.arity
+        elif self.max_arity is not None and len(argv) > self.max_arity:
+            return False
+        return len(argv) >= -self.arity
+
+    def is_key(self, index, argc):
+        if not self.first_key or index < self.first_key:
+            return False
+        last_key = self.last_key
+        if last_key < 0:
+            last_key += argc
+        return index <= last_key and \
+            (index - self.first_key) % self.key_step == 0
+
+    def get_keys(self, argv):
+        if not self.first_key:
+            return []
+        last_key = self.last_key
+        if last_key < 0:
+            last_key += len(argv)
+        keys = []
+        for arg in argv[self.first_key:last_key + 1:self.key_step]:
+            # MSET and MSETEX take their keys as a dictionary.
+            if isinstance(arg, dict):
+                keys.extend(arg)
+            else:
+                keys.append(arg)
+        return keys
+
+    def flag_names(self):
+        return [name for flag, name in _CMD_FLAG_NAMES if self.flags & flag]
+
+
+class TimingWheel(object):
+    """
+    Hierarchical timing wheel of key deadlines, in milliseconds. Level 0 has
+    one slot per millisecond, and each slot of a higher level spans a full
+    revolution of the level below it. Slots are dicts, so adding, moving and
+    removing a key are O(1). As the wheel advances, the slots of higher
+    levels are cascaded down when their time comes, and levels holding no
+    keys are skipped rather than stepped through.
+    """
+    def __init__(self, now, levels=(8, 6, 6, 6, 6)):
+        self._levels = levels
+        self._shifts = []
+        shift = 0
+        for bits in levels:
+            self._shifts.append(shift)
+            shift += bits
+        self._span = 1 << shift
+        self._time = now
+        self.clear()
+
+    def clear(self):
+        self._slots = [[{} for _ in range(1 << bits)]
+                       for bits in self._levels]
+        self._counts = [0] * len(self._levels)
+        self._deadlines = {}
+        self._where = {}
+        self._expired = {}
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def get(self, key):
+        return self._deadlines.get(key)
+
+    def items(self):
+        return self._deadlines.items()
+
+    def update(self, items):
+        # Bulk load of (key, deadline) pairs: _insert() with the level
+        # arithmetic hoisted out of the loop.
+        deadlines = self._deadlines
+        where = self._where
+        expired = self._expired
+        counts = self._counts
+        span = self._span
+        levels = [(level, 1 << (shift + bits), shift, (1 << bits) - 1,
+                   self._slots[level])
+                  for level, (shift, bits) in
+                  enumerate(zip(self._shifts, self._levels))]
+        now = self._time
+        for key, deadline in items:
+            if key in where:
+                self._unlink(key)
+            deadlines[key] = deadline
+            delta = deadline - now
+            if delta <= 0:
+                expired[key] = None
+                where[key] = (None, expired)
+                continue
+            elif delta >= span:
+                delta = span - 1
+                deadline = now + delta
+            for level, limit, shift, mask, slots in levels:
+                if delta < limit:
+                    break
+            slot = slots[(deadline >> shift) & mask]
+            slot[key] = None
+            where[key] = (level, slot)
+            counts[level] += 1
+
+    def add(self, key, deadline):
+        if key in self._where:
+            self._unlink(key)
+        self._deadlines[key] = deadline
+        self._insert(key, deadline)
+
+    def remove(self, key):
+        if key not in self._deadlines:
+            return False
+        del self._deadlines[key]
+        self._unlink(key)
+        return True
+
+    def _unlink(self, key):
+        level, slot = self._where.pop(key)
+        del slot[key]
+        if level is not None:
+            self._counts[level] -= 1
+
+    def _insert(self, key, deadline):
+        delta = deadline - self._time
+        if delta <= 0:
+            self._expired[key] = None
+            self._where[key] = (None, self._expired)
+            return
+        elif delta >= self._span:
+            # Parked in the top level and re-inserted as it cascades.
+            delta = self._span - 1
+            deadline = self._time + delta
+        for level, bits in enumerate(self._levels):
+            if delta < 1 << (self._shifts[level] + bits):
+                break
+        idx = (deadline >> self._shifts[level]) & \
+            ((1 << self._levels[level]) - 1)
+        slot = self._slots[level][idx]
+        slot[key] = None
+        self._where[key] = (level, slot)
+        self._counts[level] += 1
+
+    def _cascade(self, time):
+        for level in range(1, len(self._levels)):
+            idx = (time >> self._shifts[level]) & \
+                ((1 << self._levels[level]) - 1)
+            slot = self._slots[level][idx]
+            if slot:
+                self._slots[level][idx] = {}
+                self._counts[level] -= len(slot)
+                for key in slot:
+                    self._insert(key, self._deadlines[key])
+            if idx:
+                break
+
+    def advance(self, now):
+        mask = len(self._slots[0]) - 1
+        while self._time < now:
+            for level, count in enumerate(self._counts):
+                if count:
+                    break
+            else:
+                self._time = now
+                break
+
+            # Nothing can happen before the next revolution of the lowest
+            # level that holds keys.
+            if level:
+                time = (self._time | ((1 << self._shifts[level]) - 1)) + 1
+                if time > now:
+                    self._time = now
+                    break
+            else:
+                time = self._time + 1
+            self._time = time
+
+            if not time & mask:
+                self._cascade(time)
+            slot = self._slots[0][time & mask]
+            if slot:
+                self._slots[0][time & mask] = {}
+                self._counts[0] -= len(slot)
+                expired = (None, self._expired)
+                for key in slot:
+                    self._where[key] = expired
+                self._expired.update(slot)
+
+    def pop_expired(self, now, limit=None):
+        self.advance(now)
+        accum = []
+        while self._expired and limit != 0:
+            key = self._expired.popitem()[0]
+            del self._where[key]
+            del self._deadlines[key]
+            accum.append(key)
+            if limit is not None:
+                limit -= 1
+        return accum
+
+
+class AppendOnlyLog(object):
+    """
+    Log of the write commands run by the server, in the wire format, that is
+    replayed to rebuild the keyspace on startup. Commands are buffered and
+    written out by flush() once per batch of requests. The fsync policy is
+    'always' (on every flush, before responses are sent), 'everysec' (from
+    the background tick, at most once a second) or 'no'.
+    """
+    policies = ('always', 'everysec', 'no')
+
+    def __init__(self, filename, fsync='everysec'):
+        if fsync not in self.policies:
+            raise ValueError('Unrecognized fsync policy: %s' % fsync)
+        self.filename = filename
+        self.fsync = fsync
+        self._protocol = ProtocolHandler()
+        self._buf = BytesIO()
+        self._fh = open(filename, 'ab')
+        self._unsynced = False
+        self._last_sync = time.time()
+        self._rewrite_buf = None
+        self.size = self.base_size = self._fh.tell()
+
+    @property
+    def rewriting(self):
+        return self._rewrite_buf is not None
+
+    def append(self, argv):
+        self._protocol._write(self._buf, argv)
+
+    def flush(self):
+        if not self._buf.tell():
+            return
+        data = self._buf.getvalue()
+        self._fh.write(data)
+        self._buf.seek(0)
+        self._buf.truncate()
+        self._fh.flush()
+        self.size += len(data)
+        if self._rewrite_buf is not None:
+            self._rewrite_buf.write(data)
+        if self.fsync == 'always':
+            os.fsync(self._fh.fileno())
+        else:
+            self._unsynced = True
+
+    def sync(self, now=None):
+        now = now or time.time()
+        if self.fsync == 'everysec' and self._unsynced and \
+           now - self._last_sync >= 1:
+            os.fsync(self._fh.fileno())
+            self._unsynced = False
+            self._last_sync = now
+
+    def close(self):
+        self.flush()
+        if self.fsync != 'no':
+            os.fsync(self._fh.fileno())
+        self._fh.close()
+
+    def start_rewrite(self):
+        # Commands logged from now on are also kept in memory, to be added
+        # to the rewritten log when it is installed.
+        self._rewrite_buf = BytesIO()
+
+    def finish_rewrite(self, filename, success=True):
+        data, self._rewrite_buf = self._rewrite_buf.getvalue(), None
+        if not success:
+            # Wait for the log to grow again before retrying automatically.
+            self.base_size = self.size
+            return
+        with open(filename, 'ab') as fh:
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        self._fh.close()
+        rename(filename, self.filename)
+        self._fh = open(self.filename, 'ab')
+        self.size = self.base_size = self._fh.tell()
+
+
 KV = 0
 HASH = 1
 QUEUE = 2
 SET = 3
 
+# Snapshot record types, in addition to the data types above. EXPIRY
+# records are only found in version 1 snapshots, later versions store the
+# deadline in the record of the key itself. TOMBSTONE records, for deleted
+# keys, are only found in deltas. GENERATION identifies the base snapshot
+# that a delta applies to, and comes first when present. A PARTITIONS record
+# lists the partition files holding the keys of a partitioned snapshot.
+SCHEDULE = 4
+EXPIRY = 5
+TOMBSTONE = 6
+GENERATION = 7
+PARTITIONS = 8
+_END = 255
+
+SNAPSHOT_MAGIC = b'SIMPLEDB'
+DELTA_MAGIC = b'SDBDELTA'
+SNAPSHOT_VERSION = 2
+
+# Record flags.
+_COMPRESSED = 1
+_EXPIRES = 2
+
+_VERSION = struct.Struct('>H')
+_RECORD_HEADER = struct.Struct('>BBII')
+_UINT32 = struct.Struct('>I')
+_INT64 = struct.Struct('>q')
+_DOUBLE = struct.Struct('>d')
+
+
+def _encode_value(value, parts):
+    # Type-tagged binary encoding of a key or value, appended to parts.
+    append = parts.append
+    if value is None:
+        append(b'N')
+    elif value is True:
+        append(b'T')
+    elif value is False:
+        append(b'F')
+    elif isinstance(value, (bytes, bytearray)):
+        append(b'b')
+        append(_UINT32.pack(len(value)))
+        append(value)
+    elif isinstance(value, unicode):
+        data = value.encode('utf-8')
+        append(b'u')
+        append(_UINT32.pack(len(data)))
+        append(data)
+    elif isinstance(value, (int, long)):
+        if -2 ** 63 <= value < 2 ** 63:
+            append(b'i')
+            append(_INT64.pack(value))
+        else:
+            data = str(value).encode('ascii')
+            append(b'I')
+            append(_UINT32.pack(len(data)))
+            append(data)
+    elif isinstance(value, float):
+        append(b'f')
+        append(_DOUBLE.pack(value))
+    elif isinstance(value, (list, tuple, deque)):
+        append(b'l')
+        append(_UINT32.pack(len(value)))
+        for item in value:
+            _encode_value(item, parts)
+    elif isinstance(value, dict):
+        append(b'd')
+        append(_UINT32.pack(len(value)))
+        for key in value:
+            _encode_value(key, parts)
+            _encode_value(value[key], parts)
+    elif isinstance(value, (set, frozenset)):
+        append(b's')
+        append(_UINT32.pack(len(value)))
+        for item in value:
+            _encode_value(item, parts)
+    elif isinstance(value, datetime.datetime):
+        data = value.isoformat().encode('ascii')
+        append(b'D')
+        append(_UINT32.pack(len(data)))
+        append(data)
+    elif isinstance(value, memoryview):
+        _encode_value(value.tobytes(), parts)
+    else:
+        raise ValueError('Cannot serialize value of type %s.' %
+                         type(value).__name__)
+
+
+def _decode_value(buf, pos):
+    # Returns the value encoded at buf[pos:] and the position following it.
+    tag = buf[pos:pos + 1]
+    pos += 1
+    if tag == b'b' or tag == b'u' or tag == b'I' or tag == b'D':
+        length = _UINT32.unpack_from(buf, pos)[0]
+        pos += 4
+        data = bytes(buf[pos:pos + length])
+        pos += length
+        if tag == b'u':
+            return data.decode('utf-8'), pos
+        elif tag == b'I':
+            return int(data), pos
+        elif tag == b'D':
+            fmt = '%Y-%m-%dT%H:%M:%S.%f' if b'.' in data else \
+                '%Y-%m-%dT%H:%M:%S'
+            return datetime.datetime.strptime(data.decode('ascii'), fmt), pos
+        return data, pos
+    elif tag == b'i':
+        return _INT64.unpack_from(buf, pos)[0], pos + 8
+    elif tag == b'f':
+        return _DOUBLE.unpack_from(buf, pos)[0], pos + 8
+    elif tag == b'N':
+        return None, pos
+    elif tag == b'T':
+        return True, pos
+    elif tag == b'F':
+        return False, pos
+    elif tag == b'l' or tag == b's' or tag == b'd':
+        length = _UINT32.unpack_from(buf, pos)[0]
+        pos += 4
+        if tag == b'd':
+            value = {}
+            for _ in range(length):
+                key, pos = _decode_value(buf, pos)
+                value[key], pos = _decode_value(buf, pos)
+            return value, pos
+        items = []
+        for _ in range(length):
+            item, pos = _decode_value(buf, pos)
+            items.append(item)
+        return (set(items) if tag == b's' else items), pos
+    raise CommandError('Snapshot is corrupt: unknown value type.')
+
+
+class SnapshotWriter(object):
+    """
+    Writes a snapshot to a file one record at a time. A record holds a type,
+    a key and a value, in a type-tagged binary encoding, and ends with a CRC
+    of the record. Keys with a TTL carry their absolute deadline, in
+    milliseconds, between the key and the value. Values that encode to at
+    least `compress_threshold` bytes are zlib-compressed when that makes them
+    smaller. Deltas use the same format under a different magic string.
+    """
+    def __init__(self, fh, compress_threshold=1024, delta=False):
+        self.fh = fh
+        self.compress_threshold = compress_threshold
+        magic = DELTA_MAGIC if delta else SNAPSHOT_MAGIC
+        fh.write(magic + _VERSION.pack(SNAPSHOT_VERSION))
+
+    def write(self, record_type, key, value, deadline=None):
+        parts = []
+        _encode_value(key, parts)
+        key = b''.join(parts)
+        parts = []
+        _encode_value(value, parts)
+        body = b''.join(parts)
+
+        flags = 0
+        if len(body) >= self.compress_threshold:
+            compressed = zlib.compress(body, 1)
+            if len(compressed) < len(body):
+                body = compressed
+                flags |= _COMPRESSED
+        if deadline is not None:
+            flags |= _EXPIRES
+            key += _INT64.pack(deadline)
+
+        header = _RECORD_HEADER.pack(record_type, flags, len(key), len(body))
+        crc = zlib.crc32(body, zlib.crc32(key, zlib.crc32(header)))
+        self.fh.write(b''.join((header, key, body,
+                                _UINT32.pack(crc & 0xffffffff))))
+
+    def close(self):
+        header = _RECORD_HEADER.pack(_END, 0, 0, 0)
+        self.fh.write(header + _UINT32.pack(zlib.crc32(header) & 0xffffffff))
+
+
+class SnapshotReader(object):
+    """
+    Reads the records of a snapshot written by SnapshotWriter, one at a time,
+    as (record type, key, value, deadline) tuples. The deadline is None for
+    keys without a TTL.
+    """
+    def __init__(self, fh):
+        self.fh = fh
+        header = fh.read(len(SNAPSHOT_MAGIC) + _VERSION.size)
+        magic = header[:len(SNAPSHOT_MAGIC)]
+        if magic != SNAPSHOT_MAGIC and magic != DELTA_MAGIC:
+            raise CommandError('Unrecognized snapshot format.')
+        self.delta = magic == DELTA_MAGIC
+        self.version = _VERSION.unpack_from(header, len(SNAPSHOT_MAGIC))[0]
+        if self.version > SNAPSHOT_VERSION:
+            raise CommandError('Unsupported snapshot version: %s.' %
+                               self.version)
+
+    def __iter__(self):
+        read = self.fh.read
+        unpack_header = _RECORD_HEADER.unpack
+        unpack_crc = _UINT32.unpack_from
+        unpack_int64 = _INT64.unpack_from
+        crc32 = zlib.crc32
+        header_size = _RECORD_HEADER.size
+        while True:
+            header = read(header_size)
+            if len(header) < header_size:
+                raise CommandError('Snapshot is truncated.')
+            record_type, flags, key_len, body_len = unpack_header(header)
+            size = key_len + body_len
+            data = read(size + 4)
+            if len(data) < size + 4:
+                raise CommandError('Snapshot is truncated.')
+            if crc32(data[:size], crc32(header)) & 0xffffffff != \
+               unpack_crc(data, size)[0]:
+                raise CommandError('Snapshot is corrupt: bad checksum.')
+            elif record_type == _END:
+                return
+            elif record_type > PARTITIONS:
+                raise CommandError('Snapshot is corrupt: unknown record.')
+
+            # The key length includes the deadline, if there is one.
+            if flags & _EXPIRES:
+                deadline = unpack_int64(data, key_len - 8)[0]
+                key_end = key_len - 8
+            else:
+                deadline = None
+                key_end = key_len
+
+            # Bytes keys and values are by far the most common, so they are
+            # sliced out directly.
+            if data[:1] == b'b':
+                key = data[5:key_end]
+            else:
+                key = _decode_value(data, 0)[0]
+            if flags & _COMPRESSED:
+                value = _decode_value(zlib.decompress(data[key_len:size]),
+                                      0)[0]
+            elif data[key_len:key_len + 1] == b'b':
+                value = data[key_len + 5:size]
+            else:
+                value = _decode_value(data, key_len)[0]
+            yield record_type, key, value, deadline
+
+
+class MappedSnapshot(object):
+    """
+    Memory-mapped snapshot or delta, for restoring lazily and for applying
+    deltas. index() reads only the record headers and keys, so its cost
+    depends on the number of keys rather than the size of the data. load()
+    decodes a single record, and checks its CRC, when its value is needed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fh:
+            size = os.fstat(fh.fileno()).st_size
+            if size < len(SNAPSHOT_MAGIC) + _VERSION.size:
+                raise CommandError('Unrecognized snapshot format.')
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self._mmap[:len(SNAPSHOT_MAGIC)]
+        if magic != SNAPSHOT_MAGIC and magic != DELTA_MAGIC:
+            self.close()
+            raise CommandError('Unrecognized snapshot format.')
+        self.delta = magic == DELTA_MAGIC
+        self.version = _VERSION.unpack_from(self._mmap,
+                                            len(SNAPSHOT_MAGIC))[0]
+        if self.version > SNAPSHOT_VERSION:
+            self.close()
+            raise CommandError('Unsupported snapshot version: %s.' %
+                               self.version)
+
+        # The generation, if any, is in the first record.
+        self.generation = None
+        offset = len(SNAPSHOT_MAGIC) + _VERSION.size
+        if len(self._mmap) >= offset + _RECORD_HEADER.size and \
+           _RECORD_HEADER.unpack_from(self._mmap, offset)[0] == GENERATION:
+            try:
+                self.generation = self.load(offset)[1]
+            except Exception:
+                self.close()
+                raise
+
+    def close(self):
+        self._mmap.close()
+
+    def index(self):
+        # Yields (record type, key, offset, deadline) for each record.
+        mm = self._mmap
+        end = len(mm)
+        pos = len(SNAPSHOT_MAGIC) + _VERSION.size
+        unpack_header = _RECORD_HEADER.unpack_from
+        unpack_int64 = _INT64.unpack_from
+        header_size = _RECORD_HEADER.size
+        while True:
+            if pos + header_size > end:
+                raise CommandError('Snapshot is truncated.')
+            record_type, flags, key_len, body_len = unpack_header(mm, pos)
+            offset = pos
+            pos += header_size
+            record_end = pos + key_len + body_len + 4
+            if record_end > end:
+                raise CommandError('Snapshot is truncated.')
+            elif record_type == _END:
+                if zlib.crc32(mm[offset:pos]) & 0xffffffff != \
+                   _UINT32.unpack_from(mm, pos)[0]:
+                    raise CommandError('Snapshot is corrupt: bad checksum.')
+                return
+            elif record_type > PARTITIONS:
+                raise CommandError('Snapshot is corrupt: unknown record.')
+
+            if flags & _EXPIRES:
+                key_end = pos + key_len - 8
+                deadline = unpack_int64(mm, key_end)[0]
+            else:
+                key_end = pos + key_len
+                deadline = None
+            if mm[pos:pos + 1] == b'b':
+                key = mm[pos + 5:key_end]
+            else:
+                key = _decode_value(mm[pos:key_end], 0)[0]
+            yield record_type, key, offset, deadline
+            pos = record_end
+
+    def load(self, offset):
+        # Returns the record type and value of the record at offset.
+        mm = self._mmap
+        record_type, flags, key_len, body_len = \
+            _RECORD_HEADER.unpack_from(mm, offset)
+        pos = offset + _RECORD_HEADER.size
+        size = key_len + body_len
+        data = mm[pos:pos + size + 4]
+        if len(data) < size + 4:
+            raise CommandError('Snapshot is truncated.')
+        crc = zlib.crc32(data[:size], zlib.crc32(mm[offset:pos]))
+        if crc & 0xffffffff != _UINT32.unpack_from(data, size)[0]:
+            raise CommandError('Snapshot is corrupt: bad checksum.')
+        if flags & _COMPRESSED:
+            value = _decode_value(zlib.decompress(data[key_len:size]), 0)[0]
+        elif data[key_len:key_len + 1] == b'b':
+            value = data[key_len + 5:size]
+        else:
+            value = _decode_value(data, key_len)[0]
+        return record_type, value
+
+
+def delta_filename(filename, n):
+    return '%s.delta.%d' % (filename, n)
+
+
+def partition_paths(filename, names):
+    dirname = os.path.dirname(filename)
+    return [os.path.join(dirname, name) for name in names]
+
+
+def snapshot_size(filename):
+    # Size of a snapshot including its partitions. The PARTITIONS record
+    # comes first, after the generation, so only the start of the file is
+    # read.
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as fh:
+        for record_type, _, value, _ in SnapshotReader(fh):
+            if record_type == PARTITIONS:
+                size += sum(os.path.getsize(path)
+                            for path in partition_paths(filename, value))
+            elif record_type != GENERATION:
+                break
+    return size
+
+
+def partitions_save_id(filename):
+    # Id of the save whose partitions the snapshot lists, or 0.
+    if not os.path.exists(filename):
+        return 0
+    try:
+        with open(filename, 'rb') as fh:
+            for record_type, _, value, _ in SnapshotReader(fh):
+                if record_type == PARTITIONS:
+                    return int(decode(value[0]).rsplit('.', 2)[-2])
+                elif record_type != GENERATION:
+                    break
+    except CommandError:
+        pass  # Not a snapshot we could have partitioned.
+    return 0
+
+
+def read_partition(filename, now):
+    # Decodes the keys of a partition that have not expired by `now`, into
+    # flat lists that are cheap to send back from a pool process.
+    keys = []
+    types = []
+    values = []
+    expiry = []
+    with open(filename, 'rb') as fh:
+        for record_type, key, value, deadline in SnapshotReader(fh):
+            if record_type >= SCHEDULE:
+                continue
+            elif deadline is not None:
+                if deadline <= now:
+                    continue
+                expiry.append((key, deadline))
+            if record_type == QUEUE:
+                value = deque(value)
+            keys.append(key)
+            types.append(record_type)
+            values.append(value)
+    return keys, types, values, expiry
+
+
+def read_partitions(paths, now):
+    # Yields the result of read_partition() for each path, decoding them in
+    # a pool of processes when there is more than one CPU to run them on.
+    workers = min(len(paths), multiprocessing.cpu_count())
+    if ProcessPoolExecutor is None or workers < 2:
+        for path in paths:
+            yield read_partition(path, now)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        for result in pool.map(read_partition, paths, repeat(now)):
+            yield result
+
+
+def find_deltas(filename, generation):
+    # Returns the chain of deltas of the base snapshot `filename`, as
+    # MappedSnapshots. Deltas left over from an earlier base have a different
+    # generation and end the chain.
+    deltas = []
+    while True:
+        path = delta_filename(filename, len(deltas) + 1)
+        if not os.path.exists(path):
+            break
+        delta = MappedSnapshot(path)
+        if not delta.delta or delta.generation != generation:
+            delta.close()
+            break
+        deltas.append(delta)
+    return deltas
+
+
+class LazyValue(object):
+    """Placeholder for a value still held in a MappedSnapshot."""
+    __slots__ = ('snapshot', 'offset')
+
+    def __init__(self, snapshot, offset):
+        self.snapshot = snapshot
+        self.offset = offset
+
+
+class LazyKeyspace(dict):
+    """
+    Keyspace restored from MappedSnapshots, one per partition. Values are
+    LazyValue placeholders, decoded the first time they are read or when
+    warm_up() reaches them, whichever comes first.
+    """
+    def __init__(self, snapshots):
+        super(LazyKeyspace, self).__init__()
+        self.snapshots = snapshots
+        self.pending = []  # Keys to warm up, in the order of the files.
+        self._cursor = 0
+
+    def close(self):
+        for snapshot in self.snapshots:
+            snapshot.close()
+
+    def _decode(self, placeholder):
+        data_type, value = placeholder.snapshot.load(placeholder.offset)
+        if data_type == QUEUE:
+            value = deque(value)
+        return Value(data_type, value)
+
+    def _load(self, key, placeholder):
+        try:
+            value = self._decode(placeholder)
+        except CommandError as exc:
+            dict.__delitem__(self, key)
+            logger.error('Discarding key %r restored from %s: %s' %
+                         (key, placeholder.snapshot.filename, exc.message))
+            raise
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if value.__class__ is LazyValue:
+            value = self._load(key, value)
+        return value
+
+    def get(self, key, default=None):
+        value = dict.get(self, key, default)
+        if value.__class__ is LazyValue:
+            value = self._load(key, value)
+        return value
+
+    def pop(self, key, *default):
+        value = dict.pop(self, key, *default)
+        if value.__class__ is LazyValue:
+            value = self._decode(value)
+        return value
+
+    def items(self):
+        decode = self._decode
+        for key, value in dict.items(self):
+            if value.__class__ is LazyValue:
+                value = decode(value)
+            yield key, value
+
+    def values(self):
+        for _, value in self.items():
+            yield value
+
+    def warm_up(self, deadline, batch=100):
+        # Decodes pending values, in batches, until the deadline. Returns
+        # True once every value has been decoded.
+        pending = self.pending
+        get = dict.get
+        while self._cursor < len(pending):
+            for key in pending[self._cursor:self._cursor + batch]:
+                value = get(self, key)
+                if value.__class__ is LazyValue:
+                    try:
+                        self._load(key, value)
+                    except CommandError:
+                        pass
+            self._cursor += batch
+            if time.time() >= deadline:
+                return False
+        return True
+
+
+class ReplicationBacklog(object):
+    """
+    Circular buffer holding the most recent `size` bytes of the replication
+    stream. `offset` is the stream offset just past the newest byte, so the
+    backlog covers offsets from `offset - len(backlog)` up to `offset`.
+    """
+    def __init__(self, size, offset=0):
+        self.size = size
+        self.offset = offset
+        self._buf = bytearray(size)
+        self._pos = 0
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, data):
+        self.offset += len(data)
+        size = self.size
+        if len(data) >= size:
+            self._buf[:] = data[-size:]
+            self._pos = 0
+            self._length = size
+            return
+        end = self._pos + len(data)
+        if end <= size:
+            self._buf[self._pos:end] = data
+        else:
+            split = size - self._pos
+            self._buf[self._pos:] = data[:split]
+            self._buf[:end - size] = data[split:]
+        self._pos = end % size
+        self._length = min(self._length + len(data), size)
+
+    def read_from(self, offset):
+        # The stream from offset onwards, or None if part of it has already
+        # been overwritten.
+        count = self.offset - offset
+        if count < 0 or count > self._length:
+            return None
+        start = (self._pos - count) % self.size
+        if start + count <= self.size:
+            return bytes(self._buf[start:start + count])
+        return bytes(self._buf[start:] + self._buf[:start + count - self.size])
+
+
+class Replica(object):
+    """
+    Primary side of a replication link. Once the replica has asked to sync,
+    the write commands run by the primary are handed over with put(), and
+    held back until its snapshot has been sent. With threads or gevent, data
+    is sent by run() on the replica's own connection thread or greenlet,
+    which waits on `queue`, so a slow replica never blocks the server. With
+    asyncio there is no queue: data is written straight to the transport,
+    and only the snapshot is streamed from a thread of its own.
+    A replica resuming from the backlog starts out synced.
+    """
+    def __init__(self, offset, queue=None, synced=False):
+        self.offset = offset
+        self.conn = None
+        self.closed = False
+        self._queue = queue
+        self._pending = []
+        self._synced = synced
+
+    def attach(self, conn):
+        # Called once the reply to SYNC or PSYNC has been sent.
+        self.conn = conn
+        if self._synced:
+            self._send_pending()
+
+    def put(self, item):
+        # Items are encoded commands, a ('snapshot', filename) pair, or None
+        # to close the link.
+        if self._queue is not None:
+            self._queue.put(item)
+        elif not self.closed:
+            self._send(item)
+
+    def run(self):
+        while self._send(self._queue.get()):
+            pass
+
+    def _send(self, item):
+        if item is None:
+            self.close()
+            return False
+        elif isinstance(item, tuple):
+            if self._queue is None:
+                # Reading the file would block the event loop.
+                thread = threading.Thread(target=self._stream_snapshot,
+                                          args=(item[1],))
+                thread.daemon = True
+                thread.start()
+            else:
+                self._send_snapshot(item[1], self.conn.sendall)
+                self._snapshot_sent()
+        elif self._synced and self.conn is not None:
+            self.conn.sendall(item)
+        else:
+            self._pending.append(item)
+        return True
+
+    def _send_pending(self):
+        pending, self._pending = self._pending, []
+        for data in pending:
+            self.conn.sendall(data)
+
+    def _send_snapshot(self, filename, sendall):
+        # Sent as a bulk string, read from the file a chunk at a time.
+        try:
+            with open(filename, 'rb') as fh:
+                size = os.fstat(fh.fileno()).st_size
+                sendall(b'$%d\r\n' % size)
+                while True:
+                    data = fh.read(65536)
+                    if not data:
+                        break
+                    elif self.closed:
+                        raise EOFError()
+                    sendall(data)
+            sendall(b'\r\n')
+        finally:
+            os.unlink(filename)
+
+    def _stream_snapshot(self, filename):
+        # Runs on a thread of its own with asyncio.
+        conn = self.conn
+        try:
+            self._send_snapshot(filename, conn.sendall_threadsafe)
+        except (EOFError, socket_error):
+            conn.call_threadsafe(self.close)
+        except Exception:
+            logger.exception('Error sending a snapshot to a replica.')
+            conn.call_threadsafe(self.close)
+        else:
+            conn.call_threadsafe(self._snapshot_sent)
+
+    def _snapshot_sent(self):
+        if not self.closed:
+            self._synced = True
+            self._send_pending()
+
+    def close(self):
+        self.closed = True
+        if self._queue is None and self.conn is not None:
+            self.conn.close()
+
 
 class QueueServer(object):
+    # Active expiry: each tick spends at most `expire_budget` of the tick
+    # interval removing expired keys, in batches of `expire_sample` entries.
+    # Another batch is run only if more than `expire_threshold` of the last
+    # one had expired.
+    expire_budget = 0.25
+    expire_sample = 20
+    expire_threshold = 0.25
+
+    # After a lazy restore, each tick spends at most `warmup_budget` of the
+    # tick interval decoding values that have not been read yet.
+    warmup_budget = 0.25
+
+    # The append-only log is rewritten automatically once it is at least
+    # `log_rewrite_min_size` bytes and has grown by `log_rewrite_percentage`
+    # since it was last rewritten.
+    log_rewrite_min_size = 64 * 1024 * 1024
+    log_rewrite_percentage = 100
+
+    # When a snapshot file is configured, a background save is started once
+    # there have been at least `changes` writes and `seconds` have passed
+    # since the last successful save, for any (seconds, changes) save point.
+    # A failed save is retried after `save_retry_delay` seconds at the
+    # earliest.
+    default_save_points = ((900, 1), (300, 10), (60, 10000))
+    save_retry_delay = 5
+
+    # Commands whose arguments, besides the key, are hash fields or set
+    # members.
+    member_commands = frozenset((
+        b'HDEL', b'HEXISTS', b'HGET', b'HINCRBY', b'HMGET', b'HSET',
+        b'HSETNX', b'SADD', b'SISMEMBER', b'SREM'))
+
     def __init__(self, host='127.0.0.1', port=31337, max_clients=1024,
-                 use_gevent=True):
+                 use_gevent=True, read_size=65536, max_pipeline=1000,
+                 use_asyncio=False, loop_factory=None, reuse_port=False,
+                 hz=10, strict_clock=False, appendonly=None,
+                 appendfsync='everysec', snapshot_file=None,
+                 save_points=None, max_deltas=0, partitions=1,
+                 replicaof=None, backlog_size=1024 * 1024):
         self._host = host
         self._port = port
         self._max_clients = max_clients
-        if use_gevent:
+        self._read_size = read_size
+        self._max_pipeline = max_pipeline
+        self._hz = hz
+        self._strict_clock = strict_clock
+        self._now = time.time()
+        self._use_asyncio = use_asyncio
+        self._use_gevent = use_gevent and not use_asyncio
+        self._loop_factory = loop_factory
+        if self._use_gevent:
             if Pool is None or StreamServer is None:
                 raise Exception('gevent not installed. Please install gevent '
                                 'or instantiate QueueServer with '
                                 'use_gevent=False')
-
             self._pool = Pool(max_clients)
-            self._server = StreamServer(
-                (self._host, self._port),
-                self.connection_handler,
-                spawn=self._pool)
+
+        self._server = self.create_server((self._host, self._port),
+                                          self.connection_handler,
+                                          reuse_port)
+        self._peer_server = None
+        self._router = None
+
+        # Connection threads parse requests and send responses, but commands
+        # are run by a single thread.
+        if self._use_gevent or self._use_asyncio or Future is None:
+            self._executor = None
         else:
-            self._server = ThreadedStreamServer(
-                (self._host, self._port),
-                self.connection_handler)
+            self._executor = CommandExecutor()
 
         self._commands = self.get_commands()
         self._protocol = ProtocolHandler()
 
         self._kv = {}
         self._schedule = []
-        self._expiry = []
-        self._expiry_map = {}
+        self._expiry = TimingWheel(int(self._now * 1000))
 
         self._active_connections = 0
         self._commands_processed = 0
         self._command_errors = 0
         self._connections = 0
+        self._expired_keys = 0
+
+        self._children = {}
+        self._bgsave_started = None
+        self._last_save_time = self._last_save_duration = None
+        self._last_save_status = None
+        self._snapshot_file = snapshot_file
+        self._save_points = self.default_save_points if save_points is None \
+            else save_points
+        self._saved_at = time.time()
+        self._dirty = self._dirty_at_bgsave = 0
+
+        # With max_deltas, automatic saves write deltas holding only the keys
+        # written since the previous save, until there are max_deltas of
+        # them or they add up to the size of the base. _dirty_keys is None
+        # when the next automatic save has to write a new base.
+        self._dirty_keys = None
+        self._max_deltas = max_deltas
+        self._generation = None
+        self._save_id = 0
+        self._deltas = self._deltas_size = self._base_size = 0
+
+        # Full snapshots are split over this many files, which are restored
+        # in parallel.
+        self._partitions = partitions
+
+        # Replication: as a primary, write commands are encoded into
+        # _repl_buf and handed to the replicas after each batch. As a
+        # replica, _primary is the (host, port) being replicated. The
+        # replication id names the history the offset counts bytes of, and
+        # the backlog, created with the first replica, keeps the end of it
+        # for replicas resuming with PSYNC.
+        self._replicas = []
+        self._repl_buf = BytesIO()
+        self._repl_id = uuid.uuid4().hex
+        self._repl_offset = 0
+        self._repl_id2 = None
+        self._repl_offset2 = -1
+        self._full_syncs = self._partial_syncs = 0
+        self._backlog = None
+        self._backlog_size = backlog_size
+        self._primary = replicaof
+        self._primary_conn = None
+        self._primary_link_up = False
+
+        self._log = None
+        self._rewrite_again = False
+        if appendonly:
+            self.replay_log(appendonly)
+            self._log = AppendOnlyLog(appendonly, appendfsync)
+
+    def clock(self):
+        # Reading the time once per batch of requests, rather than once per
+        # expiry check, is accurate enough unless strict_clock is set.
+        return time.time() if self._strict_clock else self._now
+
+    def update_clock(self):
+        self._now = time.time()
 
     def check_expired(self, key, ts=None):
-        ts = ts or time.time()
-        return key in self._expiry_map and ts > self._expiry_map[key]
+        deadline = self._expiry.get(key)
+        if deadline is None:
+            return False
+        elif ts is None:
+            ts = time.time() if self._strict_clock else self._now
+        return ts * 1000 >= deadline
 
     def unexpire(self, key):
-        self._expiry_map.pop(key, None)
+        self._expiry.remove(key)
 
-    def clean_expired(self, ts=None):
-        ts = ts or time.time()
+    def clean_expired(self, ts=None, limit=None):
+        ts = ts or self.clock()
         n = 0
-        while self._expiry:
-            expires, key = heapq.heappop(self._expiry)
-            if expires > ts:
-                heapq.heappush(self._expiry, (expires, key))
-                break
-
-            if self._expiry_map.get(key) == expires:
-                del self._expiry_map[key]
-                del self._kv[key]
+        for key in self._expiry.pop_expired(int(ts * 1000), limit):
+            if self._kv.pop(key, None) is not None:
                 n += 1
+        self._expired_keys += n
         return n
 
+    def active_expire_cycle(self):
+        deadline = time.time() + self.expire_budget / self._hz
+        sample = self.expire_sample
+        n = 0
+        while True:
+            expired = self.clean_expired(limit=sample)
+            n += expired
+            if expired <= sample * self.expire_threshold or \
+               time.time() >= deadline:
+                return n
+
     def enforce_datatype(data_type, set_missing=True, subtype=None):
         def decorator(meth):
             @wraps(meth)
@@ -322,6 +2006,7 @@ class QueueServer(object):
     def check_datatype(self, data_type, key, set_missing=True, subtype=None):
         if key in self._kv and self.check_expired(key):
             del self._kv[key]
+            self.unexpire(key)
 
         if key in self._kv:
             value = self._kv[key]
@@ -340,125 +2025,843 @@ class QueueServer(object):
                 value = ''
             self._kv[key] = Value(data_type, value)
 
-    def _get_state(self):
-        return {'kv': self._kv, 'schedule': self._schedule}
-
-    def _set_state(self, state, merge=False):
-        if not merge:
-            self._kv = state['kv']
-            self._schedule = state['schedule']
-        else:
-            def merge(orig, updates):
-                orig.update(updates)
-                return orig
-            self._kv = merge(state['kv'], self._kv)
-            self._schedule = state['schedule']
-
     def save_to_disk(self, filename):
-        with open(filename, 'wb') as fh:
-            pickle.dump(self._get_state(), fh, pickle.HIGHEST_PROTOCOL)
+        filename = fsdecode(filename)
+        if filename == self._snapshot_file:
+            # Deltas written so far do not apply to this snapshot.
+            self._dirty_keys = None
+        start = time.time()
+        try:
+            self.write_snapshot(filename)
+        except Exception:
+            self._save_finished(filename, start, False)
+            raise
+        self._save_finished(filename, start, True)
+        if self._saves_changes(filename):
+            self._dirty = 0
         return True
 
-    def restore_from_disk(self, filename, merge=False):
+    def write_snapshot(self, filename, generation=None, keys=None,
+                       partitioned=True, save_id=None):
+        # Written to a temporary file first, so a failed save leaves the
+        # previous snapshot intact. Given keys, writes a delta holding only
+        # those keys, and tombstones for the ones that no longer exist.
+        partitions = None
+        if keys is None and partitioned and self._partitions > 1:
+            partitions = self.write_partitions(
+                filename, save_id or self.next_save_id(filename))
+        tmp_filename = '%s.tmp' % filename
+        with open(tmp_filename, 'wb') as fh:
+            writer = SnapshotWriter(fh, delta=keys is not None)
+            if generation is not None:
+                writer.write(GENERATION, None, generation)
+            get_deadline = self._expiry.get
+            if partitions is not None:
+                writer.write(PARTITIONS, None, partitions)
+            elif keys is None:
+                for key, value in self._kv.items():
+                    writer.write(value.data_type, key, value.value,
+                                 get_deadline(key))
+            else:
+                get = self._kv.get
+                now = int(time.time() * 1000)
+                for key in keys:
+                    value = get(key)
+                    deadline = get_deadline(key)
+                    if value is None or (deadline is not None and
+                                         deadline <= now):
+                        writer.write(TOMBSTONE, key, None)
+                    else:
+                        writer.write(value.data_type, key, value.value,
+                                     deadline)
+            # Deltas hold the whole schedule, which replaces the old one.
+            for timestamp, data in self._schedule:
+                writer.write(SCHEDULE, timestamp, data)
+            writer.close()
+            fh.flush()
+            os.fsync(fh.fileno())
+        rename(tmp_filename, filename)
+        if partitions is not None:
+            self.remove_partitions(filename, partitions)
+
+    def write_partitions(self, filename, save_id):
+        # Spreads the keys over partition files, named after the snapshot and
+        # the save, and returns their names. The partitions only take effect
+        # once the snapshot listing them has been renamed into place.
+        n = self._partitions
+        names = ['%s.%d.part%d' % (os.path.basename(filename), save_id, i)
+                 for i in range(n)]
+        paths = partition_paths(filename, names)
+        files = [open(path + '.tmp', 'wb') for path in paths]
+        try:
+            writers = [SnapshotWriter(fh) for fh in files]
+            get_deadline = self._expiry.get
+            for key, value in self._kv.items():
+                writers[hash(key) % n].write(value.data_type, key,
+                                             value.value, get_deadline(key))
+            for writer, fh in zip(writers, files):
+                writer.close()
+                fh.flush()
+                os.fsync(fh.fileno())
+        finally:
+            for fh in files:
+                fh.close()
+        for path in paths:
+            rename(path + '.tmp', path)
+        return names
+
+    def next_save_id(self, filename):
+        # Partitions are named after the save, so ids never repeat, even for
+        # saves in the same millisecond or after the clock went back. Saves
+        # made in a child are given theirs by the parent.
+        self._save_id = max(int(time.time() * 1000), self._save_id + 1,
+                            partitions_save_id(filename) + 1)
+        return self._save_id
+
+    def remove_partitions(self, filename, keep):
+        # Removes the partitions of earlier saves of the snapshot.
+        pattern = re.compile(re.escape(os.path.basename(filename)) +
+                             r'\.\d+\.part\d+$')
+        dirname = os.path.dirname(filename)
+        for name in os.listdir(dirname or '.'):
+            if pattern.match(name) and name not in keep:
+                try:
+                    os.unlink(os.path.join(dirname, name))
+                except OSError:
+                    pass
+
+    def bgsave(self, filename):
+        filename = fsdecode(filename)
+        forked = None
+        if filename == self._snapshot_file:
+            # Not a base of the deltas, so the next save has to be.
+            forked = partial(self._reset_dirty_keys, False)
+        self._start_bgsave(partial(self.write_snapshot, filename,
+                                   save_id=self.next_save_id(filename)),
+                           partial(self._bgsave_finished, filename), forked)
+        return 1
+
+    def _start_bgsave(self, fn, callback, forked=None):
+        # forked() is called once the child exists, so that a save that is
+        # rejected, or fails to fork, leaves the dirty keys as they were.
+        self.reap_children()
+        if self._bgsave_started is not None:
+            raise CommandError('Background save already in progress.')
+        self._bgsave_started = time.time()
+        self._dirty_at_bgsave = self._dirty
+        try:
+            self.run_in_child(fn, callback, forked)
+        except OSError:
+            self._bgsave_started = None
+            raise
+
+    def _reset_dirty_keys(self, track=True):
+        # Writes from now on go into the next delta, if there is one.
+        self._dirty_keys = set() if track and self._max_deltas else None
+
+    def save_snapshot_file(self):
+        # Automatic save: a delta while the chain of deltas is short, and a
+        # new base otherwise.
+        if self._dirty_keys is None or self._deltas >= self._max_deltas or \
+           self._deltas_size >= self._base_size:
+            generation = max(int(time.time() * 1000),
+                             (self._generation or 0) + 1)
+            self._start_bgsave(
+                partial(self.write_snapshot, self._snapshot_file, generation,
+                        save_id=self.next_save_id(self._snapshot_file)),
+                partial(self._base_saved, generation),
+                self._reset_dirty_keys)
+        else:
+            keys = self._dirty_keys
+            filename = delta_filename(self._snapshot_file, self._deltas + 1)
+            self._start_bgsave(
+                partial(self.write_snapshot, filename, self._generation,
+                        keys),
+                partial(self._delta_saved, filename, keys),
+                self._reset_dirty_keys)
+
+    def _base_saved(self, generation, success):
+        self._bgsave_finished(self._snapshot_file, success)
+        if not success:
+            self._dirty_keys = None
+            return
+        for n in range(1, self._deltas + 1):
+            try:
+                os.unlink(delta_filename(self._snapshot_file, n))
+            except OSError:
+                pass
+        self._generation = generation
+        self._deltas = self._deltas_size = 0
+        self._base_size = snapshot_size(self._snapshot_file)
+
+    def _delta_saved(self, filename, keys, success):
+        self._bgsave_finished(self._snapshot_file, success)
+        if success:
+            self._deltas += 1
+            self._deltas_size += os.path.getsize(filename)
+        elif self._dirty_keys is not None:
+            self._dirty_keys.update(keys)
+
+    def _bgsave_finished(self, filename, success):
+        start, self._bgsave_started = self._bgsave_started, None
+        self._save_finished(filename, start, success)
+        if not success:
+            logger.error('Background save failed.')
+        elif self._saves_changes(filename):
+            # Writes made while the child was saving are still unsaved.
+            self._dirty = max(self._dirty - self._dirty_at_bgsave, 0)
+
+    def _save_finished(self, filename, start, success):
+        self._last_save_time = time.time()
+        self._last_save_duration = self._last_save_time - start
+        self._last_save_status = 'ok' if success else 'err'
+        if success and self._saves_changes(filename):
+            self._saved_at = self._last_save_time
+
+    def _saves_changes(self, filename):
+        # Saving elsewhere than the save file, e.g. a backup, leaves the save
+        # file as stale as it was.
+        return self._snapshot_file is None or filename == self._snapshot_file
+
+    def check_save_points(self):
+        if not self._dirty or self._bgsave_started is not None:
+            return False
+        elif self._last_save_status == 'err' and \
+             self._now - self._last_save_time < self.save_retry_delay:
+            return False
+        elapsed = self._now - self._saved_at
+        for seconds, changes in self._save_points:
+            if self._dirty >= changes and elapsed >= seconds:
+                logger.info('%s changes in %s seconds, saving %s.' %
+                            (self._dirty, int(elapsed), self._snapshot_file))
+                self.save_snapshot_file()
+                return True
+        return False
+
+    def restore_from_disk(self, filename, merge=False, lazy=False):
+        # When merging, keys that already exist keep their current values.
+        # Keys whose deadline has passed are not restored.
+        # The deltas of a base snapshot are applied after it.
+        filename = fsdecode(filename)
         if not os.path.exists(filename):
             return False
+        elif lazy:
+            if merge:
+                raise CommandError('Cannot merge a snapshot lazily.')
+            generation = self._restore_lazily(filename)
+        else:
+            generation = self._restore(filename, merge)
+        if generation is not None and not merge:
+            self._restore_deltas(filename, generation)
+        return True
+
+    def _restore(self, filename, merge):
+        kv = self._kv if merge else {}
+        schedule = []
+        expiry = []
+        legacy_expiry = []
+        skipped = set()
+        generation = partitions = None
+        new_value = tuple.__new__
+        now = int(time.time() * 1000)
         with open(filename, 'rb') as fh:
-            state = pickle.load(fh)
-        self._set_state(state, merge=merge)
+            reader = SnapshotReader(fh)
+            if reader.delta:
+                raise CommandError('%s is a delta, apply it with MERGE.' %
+                                   filename)
+            for record_type, key, value, deadline in reader:
+                if record_type < SCHEDULE:
+                    if merge and key in kv:
+                        skipped.add(key)
+                        continue
+                    elif deadline is not None:
+                        if deadline <= now:
+                            continue
+                        expiry.append((key, deadline))
+                    if record_type == QUEUE:
+                        value = deque(value)
+                    kv[key] = new_value(Value, (record_type, value))
+                elif record_type == SCHEDULE:
+                    schedule.append((key, value))
+                elif record_type == GENERATION:
+                    generation = value
+                elif record_type == PARTITIONS:
+                    partitions = value
+                elif record_type == EXPIRY and key not in skipped and \
+                     key in kv:
+                    legacy_expiry.append((key, value))
+        if partitions:
+            self._restore_partitions(partition_paths(filename, partitions),
+                                     kv, expiry, now, merge)
+        self._finish_restore(kv, schedule, expiry, legacy_expiry, now, merge)
+        return generation
+
+    def _restore_partitions(self, paths, kv, expiry, now, merge):
+        # The partitions are decoded by read_partitions(), possibly in other
+        # processes, leaving only the dict to build here.
+        new_value = tuple.__new__
+        for keys, types, values, deadlines in read_partitions(paths, now):
+            if not merge:
+                kv.update(zip(keys, map(new_value, repeat(Value),
+                                        zip(types, values))))
+                expiry.extend(deadlines)
+                continue
+            added = set()
+            for key, data_type, value in zip(keys, types, values):
+                if key not in kv:
+                    kv[key] = new_value(Value, (data_type, value))
+                    added.add(key)
+            expiry.extend(item for item in deadlines if item[0] in added)
+
+    def _restore_lazily(self, filename):
+        # Only the keys are read up front, values are decoded on first
+        # access or by warm_up().
+        snapshot = MappedSnapshot(filename)
+        if snapshot.delta:
+            snapshot.close()
+            raise CommandError('%s is a delta, apply it with MERGE.' %
+                               filename)
+        kv = LazyKeyspace([snapshot])
+        pending = kv.pending
+        schedule = []
+        expiry = []
+        legacy_expiry = []
+        now = int(time.time() * 1000)
+        try:
+            # The partitions of a partitioned snapshot are indexed after it.
+            for part in kv.snapshots:
+                for record_type, key, offset, deadline in part.index():
+                    if record_type < SCHEDULE:
+                        if deadline is not None:
+                            if deadline <= now:
+                                continue
+                            expiry.append((key, deadline))
+                        kv[key] = LazyValue(part, offset)
+                        pending.append(key)
+                    elif record_type == SCHEDULE:
+                        schedule.append((key, part.load(offset)[1]))
+                    elif record_type == PARTITIONS:
+                        for path in partition_paths(filename,
+                                                    part.load(offset)[1]):
+                            kv.snapshots.append(MappedSnapshot(path))
+                    elif record_type == EXPIRY and key in kv:
+                        legacy_expiry.append((key, part.load(offset)[1]))
+        except Exception:
+            kv.close()
+            raise
+        self._finish_restore(kv, schedule, expiry, legacy_expiry, now)
+        return snapshot.generation
+
+    def _restore_deltas(self, filename, generation):
+        deltas = find_deltas(filename, generation)
+        deltas_size = sum(os.path.getsize(delta.filename)
+                          for delta in deltas)
+        if deltas:
+            self._apply_deltas(deltas)
+        if filename == self._snapshot_file:
+            # Carry on with the same chain.
+            self._generation = generation
+            self._deltas = len(deltas)
+            self._deltas_size = deltas_size
+            self._base_size = snapshot_size(filename)
+            self._dirty_keys = set() if self._max_deltas else None
+
+    def _finish_restore(self, kv, schedule, expiry, legacy_expiry, now,
+                        merge=False):
+        # Version 1 snapshots store deadlines in records of their own.
+        for key, deadline in legacy_expiry:
+            if deadline <= now:
+                del kv[key]
+            else:
+                expiry.append((key, deadline))
+
+        heapq.heapify(schedule)
+        if not merge:
+            self.replace_keyspace(kv)
+            self._expiry.clear()
+        self._schedule = schedule
+        self._expiry.update(expiry)
+        self._dirty_keys = None
+
+    def _apply_deltas(self, deltas):
+        # Newest first, so that only the latest record of each key is
+        # decoded.
+        kv = self._kv
+        seen = set()
+        schedule = []
+        expiry = []
+        now = int(time.time() * 1000)
+        try:
+            for i, delta in enumerate(reversed(deltas)):
+                for record_type, key, offset, deadline in delta.index():
+                    if record_type == SCHEDULE:
+                        if not i:
+                            schedule.append((key, delta.load(offset)[1]))
+                        continue
+                    elif record_type == GENERATION or key in seen:
+                        continue
+                    seen.add(key)
+                    self._expiry.remove(key)
+                    if record_type == TOMBSTONE or (deadline is not None and
+                                                    deadline <= now):
+                        if key in kv:
+                            del kv[key]
+                        continue
+                    data_type, value = delta.load(offset)
+                    if data_type == QUEUE:
+                        value = deque(value)
+                    kv[key] = Value(data_type, value)
+                    if deadline is not None:
+                        expiry.append((key, deadline))
+        finally:
+            for delta in deltas:
+                delta.close()
+
+        heapq.heapify(schedule)
+        self._schedule = schedule
+        self._expiry.update(expiry)
+        self._dirty_keys = None
+
+    def warm_up(self):
+        # Decode part of a lazily restored keyspace. Once it is complete, the
+        # snapshots are unmapped and the keyspace becomes a plain dict again.
+        deadline = time.time() + self.warmup_budget / self._hz
+        if self._kv.warm_up(deadline):
+            self.replace_keyspace(dict(self._kv))
+
+    def replace_keyspace(self, kv):
+        # A lazily restored keyspace keeps its snapshots mapped until it is
+        # replaced, whether it was fully decoded or not.
+        if self._kv.__class__ is LazyKeyspace:
+            self._kv.close()
+        self._kv = kv
+
+    def merge_from_disk(self, *filenames):
+        # Files are applied in order. Keys from a snapshot are only added if
+        # they do not exist yet, while deltas overwrite and delete keys.
+        filenames = [fsdecode(filename) for filename in filenames]
+        if not all(os.path.exists(filename) for filename in filenames):
+            return False
+        deltas = []
+        for filename in filenames:
+            snapshot = MappedSnapshot(filename)
+            if snapshot.delta:
+                deltas.append(snapshot)
+                continue
+            snapshot.close()
+            if deltas:
+                self._apply_deltas(deltas)
+                deltas = []
+            self.restore_from_disk(filename, merge=True)
+        if deltas:
+            self._apply_deltas(deltas)
         return True
 
-    def merge_from_disk(self, filename):
-        return self.restore_from_disk(filename, merge=True)
+    def sync(self):
+        # Full resynchronization: the replica is sent a snapshot written by a
+        # child process, then every write made since the fork.
+        self.feed_replicas()
+        self._create_backlog()
+        replica = self.create_replica(self._repl_offset)
+        fd, filename = tempfile.mkstemp(prefix='simpledb-sync-')
+        os.close(fd)
+        self._replicas.append(replica)
+        self._full_syncs += 1
+        self.run_in_child(
+            partial(self.write_snapshot, filename, partitioned=False),
+            partial(self._sync_snapshot_written, replica, filename))
+        raise ReplicaSync(replica, [b'FULLSYNC', encode(self._repl_id),
+                                    self._repl_offset])
+
+    def psync(self, repl_id, offset):
+        # Partial resynchronization: a replica that follows our history is
+        # sent what it missed from the backlog, and falls back to a full sync
+        # if that has been overwritten already.
+        try:
+            offset = int(offset)
+        except ValueError:
+            raise CommandError('Invalid offset.')
+        self.feed_replicas()
+        repl_id = decode(repl_id)
+        data = None
+        if self._backlog is not None and (
+                repl_id == self._repl_id or
+                (repl_id == self._repl_id2 and offset <= self._repl_offset2)):
+            data = self._backlog.read_from(offset)
+        if data is None:
+            logger.info('Cannot resume replication from offset %s.' % offset)
+            return self.sync()
+
+        replica = self.create_replica(offset, synced=True)
+        if data:
+            replica.put(data)
+        self._replicas.append(replica)
+        self._partial_syncs += 1
+        raise ReplicaSync(replica, [b'CONTINUE', encode(self._repl_id),
+                                    self._repl_offset])
+
+    def create_replica(self, offset, synced=False):
+        # The queue has to be gevent's under gevent: SimpleQueue was imported
+        # before monkey-patching, and its get() would block the whole hub.
+        if self._use_asyncio:
+            queue = None
+        elif self._use_gevent:
+            queue = GreenletQueue()
+        else:
+            queue = SimpleQueue()
+        return Replica(offset, queue, synced)
+
+    def _create_backlog(self):
+        if self._backlog is None and self._backlog_size > 0:
+            self._backlog = ReplicationBacklog(self._backlog_size,
+                                               self._repl_offset)
+
+    def _sync_snapshot_written(self, replica, filename, success):
+        if success and not replica.closed:
+            replica.put(('snapshot', filename))
+            return
+        elif not success:
+            logger.error('Writing the snapshot for a replica failed.')
+        replica.put(None)
+        try:
+            os.unlink(filename)
+        except OSError:
+            pass
+
+    def feed_replicas(self):
+        data = self._repl_buf.getvalue()
+        if data:
+            self._repl_buf = BytesIO()
+            self._repl_offset += len(data)
+            if self._backlog is not None:
+                self._backlog.append(data)
+        self._replicas = [replica for replica in self._replicas
+                          if not replica.closed]
+        if data:
+            for replica in self._replicas:
+                replica.put(data)
+
+    def disconnect_replicas(self):
+        self.feed_replicas()
+        for replica in self._replicas:
+            replica.put(None)
+        self._replicas = []
+
+    def new_replication_id(self, repl_id=None, promoted=False):
+        # A promoted replica's history is the one of its old primary up to
+        # the current offset, so replicas of either can still resume from
+        # there. The replicas are dropped, to learn the new id as they
+        # resume.
+        self.disconnect_replicas()
+        if promoted:
+            self._repl_id2 = self._repl_id
+            self._repl_offset2 = self._repl_offset
+        else:
+            self._repl_id2 = None
+            self._repl_offset2 = -1
+        self._repl_id = repl_id or uuid.uuid4().hex
+
+    def replicaof(self, host, port):
+        if encode(host).upper() == b'NO' and encode(port).upper() == b'ONE':
+            if self._primary is not None:
+                logger.info('No longer replicating %s:%s.' % self._primary)
+                self._primary = None
+                self._close_primary_link()
+                self.new_replication_id(promoted=True)
+            return 1
+        try:
+            primary = (decode(host), int(port))
+        except ValueError:
+            raise CommandError('Invalid port.')
+        if primary != self._primary:
+            self._primary = primary
+            self._close_primary_link()
+            self.start_replication(primary)
+        return 1
+
+    def _close_primary_link(self):
+        conn = self._primary_conn
+        if conn is not None:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket_error:
+                pass
+
+    def start_replication(self, primary):
+        if self._use_gevent:
+            gevent.spawn(self._replicate, primary, gevent.sleep)
+        else:
+            thread = threading.Thread(target=self._replicate,
+                                      args=(primary, time.sleep))
+            thread.daemon = True
+            thread.start()
+
+    def _replicate(self, primary, sleep):
+        # Runs until REPLICAOF points somewhere else, resuming whenever the
+        # link is lost.
+        while self._primary == primary:
+            try:
+                self._sync_from(primary)
+            except (EOFError, socket_error):
+                if self._primary == primary:
+                    logger.warning('Lost the link to %s:%s.' % primary)
+            except Exception:
+                logger.exception('Error replicating %s:%s.' % primary)
+            finally:
+                self._primary_link_up = False
+                conn, self._primary_conn = self._primary_conn, None
+                if conn is not None:
+                    conn.close()
+            if self._primary == primary:
+                sleep(1)
+
+    def _sync_from(self, primary):
+        conn = socket.create_connection(primary)
+        self._primary_conn = conn
+        if self._primary != primary:
+            return
+        buf = BytesIO()
+        self._protocol._write(buf, [b'PSYNC', encode(self._repl_id),
+                                    self._repl_offset])
+        conn.sendall(buf.getvalue())
+
+        # A full sync is followed by the snapshot, as a bulk string, then
+        # both are followed by the stream of write commands.
+        parser = RequestParser()
+        chunk = bytearray(self._read_size)
+        reply = parser.gets()
+        while reply is False:
+            self.read_requests(conn, parser, chunk)
+            reply = parser.gets()
+        if isinstance(reply, Error):
+            raise CommandError(reply.message)
+        status, repl_id, offset = reply
+        if status == b'FULLSYNC':
+            fd, filename = tempfile.mkstemp(prefix='simpledb-sync-')
+            try:
+                with os.fdopen(fd, 'wb') as fh:
+                    data = self._receive_snapshot(conn, parser.unparsed(),
+                                                  fh)
+                parser.feed(data)
+                self._call_from_thread(self._load_sync_snapshot, filename,
+                                       decode(repl_id), offset)
+            finally:
+                os.unlink(filename)
+            logger.info('Synchronized with %s:%s.' % primary)
+        else:
+            self._call_from_thread(self._resume_replication, decode(repl_id))
+            logger.info('Resumed replicating %s:%s from offset %s.' %
+                        (primary[0], primary[1], self._repl_offset))
+        self._primary_link_up = True
+
+        while True:
+            requests = []
+            data = parser.gets()
+            while data is not False:
+                requests.append(data)
+                data = parser.gets()
+            if requests:
+                self._call_from_thread(self.apply_replicated, requests)
+            self.read_requests(conn, parser, chunk)
+
+    def _receive_snapshot(self, conn, data, fh):
+        # Copies the snapshot to fh as it arrives, rather than holding it in
+        # memory, and returns the data received after it.
+        while b'\r\n' not in data:
+            data += self._recv(conn)
+        header, data = data.split(b'\r\n', 1)
+        if header[:1] != b'$':
+            raise CommandError('Protocol error: expected a snapshot')
+        remaining = int(header[1:])
+        while remaining:
+            if not data:
+                data = self._recv(conn)
+            nbytes = min(remaining, len(data))
+            fh.write(data[:nbytes])
+            data = data[nbytes:]
+            remaining -= nbytes
+        while len(data) < 2:
+            data += self._recv(conn)
+        if data[:2] != b'\r\n':
+            raise CommandError('Protocol error: bad bulk string')
+        return data[2:]
+
+    def _recv(self, conn):
+        data = conn.recv(self._read_size)
+        if not data:
+            raise EOFError()
+        return data
+
+    def _load_sync_snapshot(self, filename, repl_id, offset):
+        self.disconnect_replicas()
+        self.restore_from_disk(filename)
+        self.keyspace_replaced()
+        self._repl_id = repl_id
+        self._repl_id2 = None
+        self._repl_offset = offset
+        self._repl_offset2 = -1
+        self._backlog = None
+        self._create_backlog()
+
+    def _resume_replication(self, repl_id):
+        # The primary was itself promoted since we last synced.
+        if repl_id != self._repl_id:
+            self.new_replication_id(repl_id, promoted=True)
+
+    def apply_replicated(self, requests):
+        # The commands are passed on as received, so the offset and the
+        # backlog stay the same as the primary's.
+        for data in requests:
+            self._protocol._write(self._repl_buf, data)
+            try:
+                command, data = self.parse_command(data)
+                self.execute_command(command, data)
+            except CommandError as exc:
+                logger.error('Replicated command failed: %s' % exc.message)
+        self.flush_log()
+
+    def _call_from_thread(self, fn, *args):
+        # Run fn where the server's data is owned, from the replication
+        # link's thread.
+        if self._use_asyncio:
+            return self._server.call_threadsafe(fn, *args)
+        return self.call(fn, *args)
 
     def get_commands(self):
         timestamp_re = (r'(?P<timestamp>\d{4}-\d{2}-\d{2} '
                         '\d{2}:\d{2}:\d{2}(?:\.\d+)?)')
-        return dict((
+        return dict((entry[0], Command(*entry)) for entry in (
             # Queue commands.
-            (b'LPUSH', self.lpush),
-            (b'RPUSH', self.rpush),
-            (b'LPOP', self.lpop),
-            (b'RPOP', self.rpop),
-            (b'LREM', self.lrem),
-            (b'LLEN', self.llen),
-            (b'LINDEX', self.lindex),
-            (b'LRANGE', self.lrange),
-            (b'LSET', self.lset),
-            (b'LTRIM', self.ltrim),
-            (b'RPOPLPUSH', self.rpoplpush),
-            (b'LFLUSH', self.lflush),
+            (b'LPUSH', self.lpush, -3, CMD_WRITE, 1, 1, 1),
+            (b'RPUSH', self.rpush, -3, CMD_WRITE, 1, 1, 1),
+            (b'LPOP', self.lpop, 2, CMD_WRITE, 1, 1, 1),
+            (b'RPOP', self.rpop, 2, CMD_WRITE, 1, 1, 1),
+            (b'LREM', self.lrem, 3, CMD_WRITE, 1, 1, 1),
+            (b'LLEN', self.llen, 2, CMD_READONLY, 1, 1, 1),
+            (b'LINDEX', self.lindex, 3, CMD_READONLY, 1, 1, 1),
+            (b'LRANGE', self.lrange, -3, CMD_READONLY, 1, 1, 1, 4),
+            (b'LSET', self.lset, 4, CMD_WRITE, 1, 1, 1),
+            (b'LTRIM', self.ltrim, 4, CMD_WRITE, 1, 1, 1),
+            (b'RPOPLPUSH', self.rpoplpush, 3, CMD_WRITE, 1, 2, 1),
+            (b'LFLUSH', self.lflush, 2, CMD_WRITE, 1, 1, 1),
 
             # K/V commands.
-            (b'APPEND', self.kv_append),
-            (b'DECR', self.kv_decr),
-            (b'DECRBY', self.kv_decrby),
-            (b'DELETE', self.kv_delete),
-            (b'EXISTS', self.kv_exists),
-            (b'GET', self.kv_get),
-            (b'GETSET', self.kv_getset),
-            (b'INCR', self.kv_incr),
-            (b'INCRBY', self.kv_incrby),
-            (b'MDELETE', self.kv_mdelete),
-            (b'MGET', self.kv_mget),
-            (b'MPOP', self.kv_mpop),
-            (b'MSET', self.kv_mset),
-            (b'MSETEX', self.kv_msetex),
-            (b'POP', self.kv_pop),
-            (b'SET', self.kv_set),
-            (b'SETNX', self.kv_setnx),
-            (b'SETEX', self.kv_setex),
-            (b'LEN', self.kv_len),
-            (b'FLUSH', self.kv_flush),
+            (b'APPEND', self.kv_append, 3, CMD_WRITE, 1, 1, 1),
+            (b'DECR', self.kv_decr, 2, CMD_WRITE, 1, 1, 1),
+            (b'DECRBY', self.kv_decrby, 3, CMD_WRITE, 1, 1, 1),
+            (b'DELETE', self.kv_delete, 2, CMD_WRITE, 1, 1, 1),
+            (b'EXISTS', self.kv_exists, 2, CMD_READONLY, 1, 1, 1),
+            (b'GET', self.kv_get, 2, CMD_READONLY, 1, 1, 1),
+            (b'GETSET', self.kv_getset, 3, CMD_WRITE, 1, 1, 1),
+            (b'INCR', self.kv_incr, 2, CMD_WRITE, 1, 1, 1),
+            (b'INCRBY', self.kv_incrby, 3, CMD_WRITE, 1, 1, 1),
+            (b'MDELETE', self.kv_mdelete, -2, CMD_WRITE, 1, -1, 1),
+            (b'MGET', self.kv_mget, -2, CMD_READONLY, 1, -1, 1),
+            (b'MPOP', self.kv_mpop, -2, CMD_WRITE, 1, -1, 1),
+            (b'MSET', self.kv_mset, 2, CMD_WRITE, 1, 1, 1),
+            (b'MSETEX', self.kv_msetex, 3, CMD_WRITE, 1, 1, 1),
+            (b'POP', self.kv_pop, 2, CMD_WRITE, 1, 1, 1),
+            (b'SET', self.kv_set, 3, CMD_WRITE, 1, 1, 1),
+            (b'SETNX', self.kv_setnx, 3, CMD_WRITE, 1, 1, 1),
+            (b'SETEX', self.kv_setex, 4, CMD_WRITE, 1, 1, 1),
+            (b'LEN', self.kv_len, 1, CMD_READONLY, 0, 0, 0),
+            (b'FLUSH', self.kv_flush, 1, CMD_WRITE, 0, 0, 0),
 
             # Hash commands.
-            (b'HDEL', self.hdel),
-            (b'HEXISTS', self.hexists),
-            (b'HGET', self.hget),
-            (b'HGETALL', self.hgetall),
-            (b'HINCRBY', self.hincrby),
-            (b'HKEYS', self.hkeys),
-            (b'HLEN', self.hlen),
-            (b'HMGET', self.hmget),
-            (b'HMSET', self.hmset),
-            (b'HSET', self.hset),
-            (b'HSETNX', self.hsetnx),
-            (b'HVALS', self.hvals),
+            (b'HDEL', self.hdel, 3, CMD_WRITE, 1, 1, 1),
+            (b'HEXISTS', self.hexists, 3, CMD_READONLY, 1, 1, 1),
+            (b'HGET', self.hget, 3, CMD_READONLY, 1, 1, 1),
+            (b'HGETALL', self.hgetall, 2, CMD_READONLY, 1, 1, 1),
+            (b'HINCRBY', self.hincrby, -3, CMD_WRITE, 1, 1, 1, 4),
+            (b'HKEYS', self.hkeys, 2, CMD_READONLY, 1, 1, 1),
+            (b'HLEN', self.hlen, 2, CMD_READONLY, 1, 1, 1),
+            (b'HMGET', self.hmget, -2, CMD_READONLY, 1, 1, 1),
+            (b'HMSET', self.hmset, 3, CMD_WRITE, 1, 1, 1),
+            (b'HSET', self.hset, 4, CMD_WRITE, 1, 1, 1),
+            (b'HSETNX', self.hsetnx, 4, CMD_WRITE, 1, 1, 1),
+            (b'HVALS', self.hvals, 2, CMD_READONLY, 1, 1, 1),
 
             # Set commands.
-            (b'SADD', self.sadd),
-            (b'SCARD', self.scard),
-            (b'SDIFF', self.sdiff),
-            (b'SDIFFSTORE', self.sdiffstore),
-            (b'SINTER', self.sinter),
-            (b'SINTERSTORE', self.sinterstore),
-            (b'SISMEMBER', self.sismember),
-            (b'SMEMBERS', self.smembers),
-            (b'SPOP', self.spop),
-            (b'SREM', self.srem),
-            (b'SUNION', self.sunion),
-            (b'SUNIONSTORE', self.sunionstore),
+            (b'SADD', self.sadd, -2, CMD_WRITE, 1, 1, 1),
+            (b'SCARD', self.scard, 2, CMD_READONLY, 1, 1, 1),
+            (b'SDIFF', self.sdiff, -2, CMD_READONLY, 1, -1, 1),
+            (b'SDIFFSTORE', self.sdiffstore, -3, CMD_WRITE, 1, -1, 1),
+            (b'SINTER', self.sinter, -2, CMD_READONLY, 1, -1, 1),
+            (b'SINTERSTORE', self.sinterstore, -3, CMD_WRITE, 1, -1, 1),
+            (b'SISMEMBER', self.sismember, 3, CMD_READONLY, 1, 1, 1),
+            (b'SMEMBERS', self.smembers, 2, CMD_READONLY, 1, 1, 1),
+            (b'SPOP', self.spop, -2, CMD_WRITE, 1, 1, 1, 3),
+            (b'SREM', self.srem, -2, CMD_WRITE, 1, 1, 1),
+            (b'SUNION', self.sunion, -2, CMD_READONLY, 1, -1, 1),
+            (b'SUNIONSTORE', self.sunionstore, -3, CMD_WRITE, 1, -1, 1),
 
             # Schedule commands.
-            (b'ADD', self.schedule_add),
-            (b'READ', self.schedule_read),
-            (b'FLUSH_SCHEDULE', self.schedule_flush),
-            (b'LENGTH_SCHEDULE', self.schedule_length),
+            (b'ADD', self.schedule_add, 3, CMD_WRITE, 0, 0, 0),
+            (b'READ', self.schedule_read, -1, CMD_WRITE, 0, 0, 0, 2),
+            (b'FLUSH_SCHEDULE', self.schedule_flush, 1, CMD_WRITE, 0, 0, 0),
+            (b'LENGTH_SCHEDULE', self.schedule_length, 1, CMD_READONLY,
+             0, 0, 0),
 
             # Misc.
-            (b'EXPIRE', self.expire),
-            (b'INFO', self.info),
-            (b'FLUSHALL', self.flush_all),
-            (b'SAVE', self.save_to_disk),
-            (b'RESTORE', self.restore_from_disk),
-            (b'MERGE', self.merge_from_disk),
-            (b'QUIT', self.client_quit),
-            (b'SHUTDOWN', self.shutdown),
+            (b'EXPIRE', self.expire, 3, CMD_WRITE, 1, 1, 1),
+            (b'EXPIREAT', self.expireat, 3, CMD_WRITE, 1, 1, 1),
+            (b'PEXPIRE', self.pexpire, 3, CMD_WRITE, 1, 1, 1),
+            (b'PEXPIREAT', self.pexpireat, 3, CMD_WRITE, 1, 1, 1),
+            (b'PERSIST', self.persist, 2, CMD_WRITE, 1, 1, 1),
+            (b'TTL', self.ttl, 2, CMD_READONLY, 1, 1, 1),
+            (b'PTTL', self.pttl, 2, CMD_READONLY, 1, 1, 1),
+            (b'INFO', self.info, 1, CMD_READONLY | CMD_ADMIN, 0, 0, 0),
+            (b'COMMAND', self.command_info, -1, CMD_READONLY, 0, 0, 0),
+            (b'FLUSHALL', self.flush_all, 1, CMD_WRITE, 0, 0, 0),
+            (b'SAVE', self.save_to_disk, 2, CMD_READONLY | CMD_ADMIN,
+             0, 0, 0),
+            (b'BGSAVE', self.bgsave, 2, CMD_READONLY | CMD_ADMIN, 0, 0, 0),
+            (b'RESTORE', self.restore_from_disk, 2, CMD_WRITE | CMD_ADMIN,
+             0, 0, 0),
+            (b'MERGE', self.merge_from_disk, -2, CMD_WRITE | CMD_ADMIN,
+             0, 0, 0),
+            (b'REWRITELOG', self.rewrite_log, 1, CMD_ADMIN, 0, 0, 0),
+            (b'REPLICAOF', self.replicaof, 3, CMD_ADMIN, 0, 0, 0),
+            (b'SYNC', self.sync, 1, CMD_READONLY | CMD_ADMIN, 0, 0, 0),
+            (b'PSYNC', self.psync, 3, CMD_READONLY | CMD_ADMIN, 0, 0, 0),
+            (b'QUIT', self.client_quit, 1, CMD_READONLY, 0, 0, 0),
+            (b'SHUTDOWN', self.shutdown, 1, CMD_ADMIN, 0, 0, 0),
         ))
 
     def expire(self, key, nseconds):
-        eta = time.time() + nseconds
-        self._expiry_map[key] = eta
-        heapq.heappush(self._expiry, (eta, key))
+        self._expiry.add(key, int((self.clock() + nseconds) * 1000))
+
+    def _expire_at(self, key, deadline):
+        if key not in self._kv or self.check_expired(key):
+            return 0
+        self._expiry.add(key, deadline)
+        return 1
+
+    def expireat(self, key, timestamp):
+        return self._expire_at(key, int(timestamp * 1000))
+
+    def pexpire(self, key, milliseconds):
+        return self._expire_at(key, int(self.clock() * 1000) + milliseconds)
+
+    def pexpireat(self, key, timestamp):
+        return self._expire_at(key, timestamp)
+
+    def persist(self, key):
+        if key not in self._kv or self.check_expired(key):
+            return 0
+        return 1 if self._expiry.remove(key) else 0
+
+    def pttl(self, key):
+        if key not in self._kv or self.check_expired(key):
+            return -2
+        deadline = self._expiry.get(key)
+        if deadline is None:
+            return -1
+        return max(deadline - int(self.clock() * 1000), 0)
+
+    def ttl(self, key):
+        pttl = self.pttl(key)
+        return pttl if pttl < 0 else (pttl + 500) // 1000
 
     @enforce_datatype(QUEUE)
     def lpush(self, key, *values):
@@ -575,6 +2978,7 @@ class QueueServer(object):
     def kv_delete(self, key):
         if key in self._kv:
             del self._kv[key]
+            self.unexpire(key)
             return 1
         return 0
 
@@ -609,6 +3013,7 @@ class QueueServer(object):
             except KeyError:
                 pass
             else:
+                self.unexpire(key)
                 n += 1
         return n
 
@@ -626,6 +3031,7 @@ class QueueServer(object):
         for key in keys:
             if key in self._kv and not self.check_expired(key):
                 accum.append(self._kv.pop(key).value)
+                self.unexpire(key)
             else:
                 accum.append(None)
         return accum
@@ -651,6 +3057,7 @@ class QueueServer(object):
 
     def kv_pop(self, key):
         if key in self._kv and not self.check_expired(key):
+            self.unexpire(key)
             return self._kv.pop(key).value
 
     def kv_set(self, key, value):
@@ -685,9 +3092,9 @@ class QueueServer(object):
 
     def kv_flush(self):
         kvlen = self.kv_len()
-        self._kv.clear()
-        self._expiry = []
-        self._expiry_map = {}
+        self.replace_keyspace({})
+        self._expiry.clear()
+        self._dirty_keys = None
         return kvlen
 
     def _decode_timestamp(self, timestamp):
@@ -885,18 +3292,50 @@ class QueueServer(object):
             'commands_processed': self._commands_processed,
             'command_errors': self._command_errors,
             'connections': self._connections,
+            'expired_keys': self._expired_keys,
+            'bgsave_in_progress': self._bgsave_started is not None,
+            'last_save_time': self._last_save_time,
+            'last_save_duration': self._last_save_duration,
+            'last_save_status': self._last_save_status,
+            'changes_since_last_save': self._dirty,
+            'snapshot_deltas': self._deltas,
+            'role': 'replica' if self._primary else 'primary',
+            'connected_replicas': len(self._replicas),
+            'replication_id': self._repl_id,
+            'replication_offset': self._repl_offset,
+            'replication_backlog': len(self._backlog or ()),
+            'full_syncs': self._full_syncs,
+            'partial_syncs': self._partial_syncs,
+            'primary_link_up': self._primary_link_up,
+            'log_rewrite_in_progress': bool(self._log and self._log.rewriting),
+            'log_size': self._log.size if self._log else 0,
+            'lazy_restore_in_progress': self._kv.__class__ is LazyKeyspace,
             'keys': len(self._kv),
-            'timestamp': time.time()}
+            'timestamp': self.clock()}
 
     def flush_all(self):
         self.kv_flush()
         self.schedule_flush()
         return 1
 
-    def add_command(self, command, callback):
+    def add_command(self, command, callback, arity=None, flags=0,
+                    first_key=0, last_key=0, key_step=0, max_arity=None):
         if isinstance(command, unicode):
             command = command.encode('utf-8')
-        self._commands[command] = callback
+        self._commands[command] = Command(command, callback, arity, flags,
+                                          first_key, last_key, key_step,
+                                          max_arity)
+
+    def command_info(self, *names):
+        names = [encode(name).upper() for name in names] or self._commands
+        accum = {}
+        for name in names:
+            command = self._commands.get(name)
+            if command is not None:
+                accum[name] = [command.arity, command.flag_names(),
+                               command.first_key, command.last_key,
+                               command.key_step]
+        return accum
 
     def client_quit(self):
         raise ClientQuit('client closed connection')
@@ -904,38 +3343,218 @@ class QueueServer(object):
     def shutdown(self):
         raise Shutdown('shutting down')
 
+    def create_server(self, address, handler, reuse_port=False):
+        if self._use_asyncio:
+            return AsyncioStreamServer(address,
+                                       lambda: AsyncioConnection(self),
+                                       self._loop_factory, reuse_port)
+        elif self._use_gevent:
+            if reuse_port:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                listener.bind(address)
+                listener.listen(socket.SOMAXCONN)
+                address = listener
+            return StreamServer(address, handler, spawn=self._pool)
+        return ThreadedStreamServer(address, handler, reuse_port)
+
+    def enable_sharding(self, index, peers):
+        # Serve only part of the keyspace as worker `index` of len(peers).
+        # Each (host, port) in peers is a worker's private address, used to
+        # forward commands to it.
+        if self._use_asyncio:
+            raise Exception('Sharding is not supported with asyncio.')
+        self._router = ShardRouter(self, index, peers)
+        self._peer_server = self.create_server(
+            peers[index],
+            partial(self.connection_handler, local=True))
+
+    def tick(self):
+        # Periodic housekeeping, run `hz` times a second.
+        self.update_clock()
+        self.active_expire_cycle()
+        if self._kv.__class__ is LazyKeyspace:
+            self.warm_up()
+        self.reap_children()
+        if self._log is not None:
+            self._log.sync(self._now)
+            if not self._log.rewriting and \
+               self._log.size >= self.log_rewrite_min_size and \
+               self._log.size >= self._log.base_size * \
+               (1 + self.log_rewrite_percentage / 100.):
+                self.rewrite_log()
+        if self._snapshot_file is not None:
+            self.check_save_points()
+
+    def _run_tick(self):
+        try:
+            self.call(self.tick)
+        except Exception:
+            logger.exception('Error running background tasks.')
+
+    def _tick_forever(self, sleep):
+        interval = 1. / self._hz
+        while True:
+            sleep(interval)
+            self._run_tick()
+
+    def start_ticker(self):
+        if not self._hz:
+            return
+        elif self._use_asyncio:
+            self._server.call_periodically(1. / self._hz, self._run_tick)
+        elif self._use_gevent:
+            gevent.spawn(self._tick_forever, gevent.sleep)
+        else:
+            thread = threading.Thread(target=self._tick_forever,
+                                      args=(time.sleep,))
+            thread.daemon = True
+            thread.start()
+
     def run(self):
-        self._server.serve_forever()
+        if self._peer_server is not None:
+            self._peer_server.start()
+        self.start_ticker()
+        if self._primary is not None:
+            self.start_replication(self._primary)
+        try:
+            self._server.serve_forever()
+        finally:
+            if self._log is not None:
+                self.call(self._log.close)
 
-    def connection_handler(self, conn, address):
+    def connection_handler(self, conn, address, local=False):
         logger.info('Connection received: %s:%s' % address)
-        socket_file = conn.makefile('rwb')
+        parser = RequestParser()
+        chunk = bytearray(self._read_size)
         self._active_connections += 1
         while True:
             try:
-                self.request_response(socket_file)
-            except EOFError:
+                self.read_requests(conn, parser, chunk)
+                self.process_requests(conn, parser, local)
+            except (EOFError, socket_error):
                 logger.info('Client went away: %s:%s' % address)
-                socket_file.close()
                 break
             except ClientQuit:
                 logger.info('Client exited: %s:%s.' % address)
                 break
+            except ReplicaSync as exc:
+                # This thread now sends the replica its data, until the link
+                # is closed.
+                logger.info('Replica connected: %s:%s' % address)
+                exc.replica.attach(conn)
+                try:
+                    exc.replica.run()
+                except (EOFError, socket_error):
+                    pass
+                finally:
+                    exc.replica.closed = True
+                logger.info('Replica went away: %s:%s' % address)
+                break
+            except CommandError as exc:
+                # The stream cannot be re-synchronized after a protocol error.
+                logger.info('Protocol error from %s:%s: %s' %
+                            (address[0], address[1], exc.message))
+                self._protocol.send_responses(conn, [Error(exc.message)])
+                break
             except Exception as exc:
                 logger.exception('Error processing command.')
         self._active_connections -= 1
 
-    def request_response(self, socket_file):
-        data = self._protocol.handle_request(socket_file)
+    def read_requests(self, conn, parser, chunk):
+        target = parser.get_buffer()
+        if target is not None:
+            # Large bulk string in progress, receive straight into it.
+            with target:
+                nbytes = conn.recv_into(target)
+            if not nbytes:
+                raise EOFError()
+            parser.buffer_updated(nbytes)
+            return
+
+        nbytes = conn.recv_into(chunk)
+        if not nbytes:
+            raise EOFError()
+        with memoryview(chunk) as view:
+            parser.feed(view[:nbytes])
 
+    def process_requests(self, conn, parser, local=False):
+        # Run every complete request that has been received, in order, and
+        # send the responses back together, at most max_pipeline at a time.
+        # A protocol error is raised once the requests before it have run.
+        while True:
+            requests = []
+            error = None
+            try:
+                data = parser.gets()
+                while data is not False:
+                    requests.append(data)
+                    if len(requests) == self._max_pipeline:
+                        break
+                    data = parser.gets()
+            except CommandError as exc:
+                error = exc
+
+            if requests:
+                if self._executor is not None and (local or
+                                                   self._router is None):
+                    buf, exc = self._executor.call(
+                        self.run_and_encode, requests, local)
+                else:
+                    buf, exc = self.run_and_encode(requests, local)
+                buf.send(conn)
+                if exc is not None:
+                    raise exc
+            if error is not None:
+                raise error
+            elif len(requests) < self._max_pipeline:
+                return
+
+    def run_requests(self, requests, local=False):
+        # Returns the responses, and the ClientQuit or KeyboardInterrupt that
+        # stopped the batch early, if any.
+        self.update_clock()
+        responses = []
+        for data in requests:
+            try:
+                responses.append(self.request_response(data, local))
+            except (ClientQuit, KeyboardInterrupt) as exc:
+                responses.append(1)
+                self.flush_log()
+                return responses, exc
+            except ReplicaSync as exc:
+                responses.append(exc.reply)
+                self.flush_log()
+                return responses, exc
+        self.flush_log()
+        return responses, None
+
+    def run_and_encode(self, requests, local=False):
+        # On the executor, the responses are encoded there too: SMEMBERS,
+        # HGETALL and the like return the containers of the keyspace, which
+        # other connections may change as soon as the executor moves on.
+        responses, exc = self.run_requests(requests, local)
+        return self._protocol.encode_responses(responses), exc
+
+    def flush_log(self):
+        # Hand the write commands of the batch to the append-only log and to
+        # the replicas.
+        if self._log is not None:
+            self.call(self._log.flush)
+        if self._repl_buf.tell():
+            self.call(self.feed_replicas)
+
+    def request_response(self, data, local=False):
         try:
-            resp = self.respond(data)
+            if local or self._router is None:
+                resp = self.respond(data)
+            else:
+                resp = self._router.respond(data)
         except Shutdown:
             logger.info('Shutting down')
-            self._protocol.write_response(socket_file, 1)
             raise KeyboardInterrupt
-        except ClientQuit:
-            self._protocol.write_response(socket_file, 1)
+        except (ClientQuit, ReplicaSync):
             raise
         except CommandError as command_error:
             resp = Error(command_error.message)
@@ -945,26 +3564,395 @@ class QueueServer(object):
             resp = Error('Unhandled server error')
         else:
             self._commands_processed += 1
+        return resp
 
-        self._protocol.write_response(socket_file, resp)
+    def respond(self, data, detach=False):
+        # With detach, a container of the keyspace is returned as a copy, for
+        # callers that use the result outside the executor.
+        command, data = self.parse_command(data)
+        if self._primary is not None and command.flags & CMD_WRITE:
+            raise CommandError('Cannot write to a replica.')
+        elif detach and self._executor is not None:
+            return self._executor.call(self._execute_detached, command, data)
+        return self.call(self.execute_command, command, data)
+
+    def _execute_detached(self, command, data):
+        result = self.execute_command(command, data)
+        if isinstance(result, (dict, set, deque)):
+            # Their items are immutable, so a shallow copy will do.
+            return result.__class__(result)
+        return result
+
+    def call(self, fn, *args):
+        # Run fn on the thread that owns the server's data.
+        if self._executor is not None:
+            return self._executor.call(fn, *args)
+        return fn(*args)
+
+    def execute_command(self, command, data):
+        result = command.callback(*data[1:])
+        if command.flags & CMD_WRITE:
+            if command.flags & CMD_ADMIN and not result:
+                # RESTORE or MERGE of a missing file: nothing changed.
+                return result
+            self._dirty += 1
+            if self._dirty_keys is not None:
+                self._dirty_keys.update(command.get_keys(data))
+            if command.flags & CMD_ADMIN:
+                # RESTORE and MERGE are neither logged nor replicated. The
+                # log is rewritten from the new data instead, and as it no
+                # longer follows the replication history, replicas sync
+                # again.
+                self.keyspace_replaced()
+                self.new_replication_id()
+            elif self._log is not None or self._backlog is not None:
+                # A replica streams the commands of its primary instead, see
+                # apply_replicated().
+                replicate = self._backlog is not None and self._primary is None
+                for argv in self.log_entries(command.name, data, result):
+                    if self._log is not None:
+                        self._log.append(argv)
+                    if replicate:
+                        self._protocol._write(self._repl_buf, argv)
+        return result
+
+    def log_entries(self, name, data, result):
+        # Commands are logged so that replaying them has the same effect:
+        # relative expiry times become absolute and SPOP becomes SREM.
+        if name in (b'EXPIRE', b'EXPIREAT', b'PEXPIRE', b'PEXPIREAT'):
+            return self._log_expiry(data[1])
+        elif name == b'SETEX':
+            return [[b'SET', data[1], data[2]]] + self._log_expiry(data[1])
+        elif name == b'MSETEX':
+            accum = [[b'MSET', data[1]]]
+            for key in data[1]:
+                accum.extend(self._log_expiry(key))
+            return accum
+        elif name == b'SPOP':
+            return [[b'SREM', data[1]] + result] if result else []
+        return [data]
+
+    def rewrite_log(self):
+        if self._log is None:
+            raise CommandError('Append-only log is not enabled.')
+        elif self._log.rewriting:
+            raise CommandError('Log rewrite already in progress.')
+        filename = self._log.filename + '.rewrite'
+        # Commands still buffered are part of the child's snapshot already,
+        # and must not be copied into the rewrite buffer as well.
+        self._log.flush()
+        self._log.start_rewrite()
+        logger.info('Rewriting %s.' % self._log.filename)
+        self.run_in_child(partial(self.write_log_snapshot, filename),
+                          partial(self._finish_rewrite, filename))
+        return 1
 
-    def respond(self, data):
+    def keyspace_replaced(self):
+        # The log cannot be replayed to the current data any more. A rewrite
+        # already in progress started from the old data, so another one is
+        # needed once it is done.
+        if self._log is None:
+            return
+        elif self._log.rewriting:
+            self._rewrite_again = True
+        else:
+            self.rewrite_log()
+
+    def _finish_rewrite(self, filename, success):
+        self._log.finish_rewrite(filename, success)
+        if success:
+            logger.info('Rewrote %s (%s bytes).' % (self._log.filename,
+                                                    self._log.size))
+        else:
+            logger.error('Rewriting %s failed.' % self._log.filename)
+        if self._rewrite_again:
+            self._rewrite_again = False
+            self.rewrite_log()
+
+    def write_log_snapshot(self, filename, batch_size=1000):
+        # Write the commands that recreate the current data: MSET batches
+        # for plain values, SET for hashes, queues and sets, then expiry
+        # times and scheduled items.
+        protocol = ProtocolHandler()
+        buf = BytesIO()
+        with open(filename, 'wb') as fh:
+            def write(argv):
+                protocol._write(buf, argv)
+                if buf.tell() >= 1024 * 1024:
+                    fh.write(buf.getvalue())
+                    buf.seek(0)
+                    buf.truncate()
+
+            values = {}
+            for key, value in self._kv.items():
+                if value.data_type == KV:
+                    values[key] = value.value
+                    if len(values) == batch_size:
+                        write([b'MSET', values])
+                        values = {}
+                elif value.data_type == QUEUE:
+                    write([b'SET', key, list(value.value)])
+                else:
+                    write([b'SET', key, value.value])
+            if values:
+                write([b'MSET', values])
+            for key, deadline in self._expiry.items():
+                write([b'PEXPIREAT', key, deadline])
+            for timestamp, data in self._schedule:
+                write([b'ADD', str(timestamp), data])
+
+            fh.write(buf.getvalue())
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    def run_in_child(self, fn, callback, forked=None):
+        # Run fn in a forked child, which sees a copy-on-write snapshot of the
+        # data, and call callback(success) from the tick once it exits. fn is
+        # run inline where fork() is not available. forked() is called in the
+        # parent once the child exists.
+        if not hasattr(os, 'fork'):
+            if forked is not None:
+                forked()
+            try:
+                fn()
+            except Exception:
+                logger.exception('Error running %s.' % fn)
+                callback(False)
+            else:
+                callback(True)
+            return
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                fn()
+                status = 0
+            finally:
+                os._exit(status)
+        self._children[pid] = callback
+        if forked is not None:
+            forked()
+
+    def reap_children(self):
+        for pid in list(self._children):
+            try:
+                done, status = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                done, status = pid, -1
+            if done:
+                self._children.pop(pid)(status == 0)
+
+    def _log_expiry(self, key):
+        deadline = self._expiry.get(key)
+        if deadline is None:
+            return []
+        return [[b'PEXPIREAT', key, deadline]]
+
+    def replay_log(self, filename):
+        # Rebuild the keyspace from an append-only log. A command left
+        # incomplete at the end of the log, e.g. by a crash, is truncated.
+        if not os.path.exists(filename):
+            return 0
+        self.update_clock()
+        parser = RequestParser()
+        chunk = bytearray(self._read_size)
+        total = complete = n = 0
+        with open(filename, 'rb') as fh:
+            while True:
+                target = parser.get_buffer()
+                if target is not None:
+                    with target:
+                        nbytes = fh.readinto(target)
+                    parser.buffer_updated(nbytes)
+                else:
+                    nbytes = fh.readinto(chunk)
+                    with memoryview(chunk) as view:
+                        parser.feed(view[:nbytes])
+                if not nbytes:
+                    break
+                total += nbytes
+
+                data = parser.gets()
+                while data is not False:
+                    command, data = self.parse_command(data)
+                    try:
+                        command.callback(*data[1:])
+                    except CommandError as exc:
+                        logger.warning('Error replaying %s: %s' %
+                                       (decode(command.name), exc.message))
+                    n += 1
+                    complete = total - parser.buffered()
+                    data = parser.gets()
+
+        if complete < total:
+            logger.warning('Truncating incomplete command at the end of %s.' %
+                           filename)
+            with open(filename, 'r+b') as fh:
+                fh.truncate(complete)
+        logger.info('Replayed %s commands from %s.' % (n, filename))
+        return n
+
+    def parse_command(self, data):
         if not isinstance(data, list):
             try:
                 data = data.split()
             except:
                 raise CommandError('Unrecognized request type.')
 
-        if not isinstance(data[0], basestring):
+        if not data:
+            raise CommandError('Missing command name.')
+        elif not isinstance(data[0], basestring):
             raise CommandError('First parameter must be command name.')
 
-        command = data[0].upper()
-        if command not in self._commands:
-            raise CommandError('Unrecognized command: %s' % command)
+        command = self._commands.get(data[0].upper())
+        if command is None:
+            raise CommandError('Unrecognized command: %s' % data[0].upper())
         else:
-            logger.debug('Received %s', decode(command))
+            logger.debug('Received %s', decode(command.name))
+
+        if not command.check_arity(data):
+            raise CommandError('Wrong number of arguments for %s' %
+                               decode(command.name))
+
+        # Large arguments are received as bytearrays, which cannot be used
+        # as keys, hash fields or set members.
+        for i, arg in enumerate(data):
+            if arg.__class__ is bytearray and (
+                    command.name in self.member_commands or
+                    command.is_key(i, len(data))):
+                data[i] = bytes(arg)
+        return command, data
+
+
+class ShardRouter(object):
+    """
+    Routes commands between worker processes that each own part of the
+    keyspace: a key belongs to worker crc32(key) % workers. Commands whose
+    keys all belong to one worker are run by that worker, multi-key commands
+    are split up and their results merged, and keyspace-wide commands are
+    sent to every worker. Schedule commands are always run by worker 0.
+    """
+    def __init__(self, server, index, peers):
+        self.server = server
+        self.index = index
+        self.workers = len(peers)
+        self.peers = [None if i == index else Client(host, port)
+                      for i, (host, port) in enumerate(peers)]
+        self._split = {
+            b'MDELETE': self.mdelete,
+            b'MGET': self.mget,
+            b'MPOP': self.mget,
+            b'MSET': self.mset,
+            b'MSETEX': self.msetex,
+            b'SDIFF': partial(self.set_op, operator.isub),
+            b'SINTER': partial(self.set_op, operator.iand),
+            b'SUNION': partial(self.set_op, operator.ior),
+            b'SDIFFSTORE': partial(self.set_store, operator.isub),
+            b'SINTERSTORE': partial(self.set_store, operator.iand),
+            b'SUNIONSTORE': partial(self.set_store, operator.ior)}
+        self._broadcast = {
+            b'FLUSH': lambda argv: sum(self.broadcast(argv)),
+            b'FLUSHALL': lambda argv: min(self.broadcast(argv)),
+            b'LEN': lambda argv: sum(self.broadcast(argv)),
+            b'REWRITELOG': lambda argv: min(self.broadcast(argv)),
+            b'SHUTDOWN': self.shutdown}
+        self._pinned = (b'ADD', b'READ', b'FLUSH_SCHEDULE', b'LENGTH_SCHEDULE')
+
+    def owner(self, key):
+        return (zlib.crc32(encode(key)) & 0xffffffff) % self.workers
 
-        return self._commands[command](*data[1:])
+    def respond(self, data):
+        command, argv = self.server.parse_command(data)
+        name = command.name
+        if name in self._broadcast:
+            return self._broadcast[name](argv)
+        elif name in self._pinned:
+            return self.call(0, argv)
+
+        owners = set(self.owner(key) for key in command.get_keys(argv))
+        if not owners:
+            return self.server.respond(argv, detach=True)
+        elif len(owners) == 1:
+            return self.call(owners.pop(), argv)
+        elif name in self._split:
+            return self._split[name](argv)
+        raise CommandError('Keys for %s belong to different shards' %
+                           decode(name))
+
+    def call(self, owner, argv):
+        if owner == self.index:
+            return self.server.respond(argv, detach=True)
+        try:
+            return self.peers[owner].execute(*argv)
+        except ServerError:
+            raise CommandError('Shard %s is unavailable' % owner)
+
+    def broadcast(self, argv):
+        return [self.call(owner, argv) for owner in range(self.workers)]
+
+    def group(self, keys):
+        groups = {}
+        for idx, key in enumerate(keys):
+            groups.setdefault(self.owner(key), []).append(idx)
+        return groups
+
+    def mdelete(self, argv):
+        keys = argv[1:]
+        return sum(self.call(owner, argv[:1] + [keys[i] for i in idxs])
+                   for owner, idxs in self.group(keys).items())
+
+    def mget(self, argv):
+        keys = argv[1:]
+        accum = [None] * len(keys)
+        for owner, idxs in self.group(keys).items():
+            values = self.call(owner, argv[:1] + [keys[i] for i in idxs])
+            for idx, value in zip(idxs, values):
+                accum[idx] = value
+        return accum
+
+    def _mset(self, argv):
+        parts = {}
+        for key, value in argv[1].items():
+            parts.setdefault(self.owner(key), {})[key] = value
+        return [self.call(owner, [argv[0], data] + argv[2:])
+                for owner, data in parts.items()]
+
+    def mset(self, argv):
+        return sum(self._mset(argv))
+
+    def msetex(self, argv):
+        self._mset(argv)
+
+    def members(self, key):
+        return set(self.call(self.owner(key), [b'SMEMBERS', key]))
+
+    def combine(self, op, keys):
+        src = self.members(keys[0])
+        for key in keys[1:]:
+            src = op(src, self.members(key))
+        return src
+
+    def set_op(self, op, argv):
+        return list(self.combine(op, argv[1:]))
+
+    def set_store(self, op, argv):
+        dest = argv[1]
+        src = self.combine(op, argv[2:])
+        owner = self.owner(dest)
+        self.call(owner, [b'SCARD', dest])  # Fails if dest is not a set.
+        self.call(owner, [b'DELETE', dest])
+        self.call(owner, [b'SADD', dest] + list(src))
+        return len(src)
+
+    def shutdown(self, argv):
+        for owner in range(self.workers):
+            if owner != self.index:
+                try:
+                    self.call(owner, argv)
+                except CommandError:
+                    pass
+        return self.server.respond(argv, detach=True)
 
 
 class SocketPool(object):
@@ -1059,6 +4047,9 @@ class Client(object):
     def close(self):
         self.execute(b'QUIT')
 
+    def pipeline(self):
+        return Pipeline(self)
+
     def command(cmd):
         def method(self, *args):
             return self.execute(cmd.encode('utf-8'), *args)
@@ -1130,11 +4121,21 @@ class Client(object):
     length_schedule = command('LENGTH_SCHEDULE')
 
     expire = command('EXPIRE')
+    expireat = command('EXPIREAT')
+    pexpire = command('PEXPIRE')
+    pexpireat = command('PEXPIREAT')
+    persist = command('PERSIST')
+    ttl = command('TTL')
+    pttl = command('PTTL')
     info = command('INFO')
+    command_info = command('COMMAND')
     flushall = command('FLUSHALL')
     save = command('SAVE')
+    bgsave = command('BGSAVE')
     restore = command('RESTORE')
     merge = command('MERGE')
+    rewrite_log = command('REWRITELOG')
+    replicaof = command('REPLICAOF')
     quit = command('QUIT')
     shutdown = command('SHUTDOWN')
 
@@ -1157,6 +4158,64 @@ class Client(object):
         return self.length()
 
 
+class Pipeline(Client):
+    def __init__(self, client):
+        self._host = client._host
+        self._port = client._port
+        self._socket_pool = client._socket_pool
+        self._protocol = client._protocol
+        self._queue = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None and self._queue:
+            self.send()
+        else:
+            self._queue = []
+
+    def execute(self, *args):
+        self._queue.append(args)
+        return self
+
+    def send(self):
+        commands, self._queue = self._queue, []
+        if not commands:
+            self.results = []
+            return self.results
+
+        conn = self._socket_pool.checkout()
+        close_conn = any(args[0] in (b'QUIT', b'SHUTDOWN') for args in commands)
+        self._protocol.write_responses(conn, commands)
+        responses = []
+        try:
+            for _ in commands:
+                responses.append(self._protocol.handle_request(conn))
+        except EOFError:
+            self._socket_pool.close()
+            raise ServerDisconnect('server went away')
+        except Exception:
+            self._socket_pool.close()
+            raise ServerInternalError('internal server error')
+        else:
+            if close_conn:
+                self._socket_pool.close()
+            else:
+                self._socket_pool.checkin()
+
+        # Errors are returned in place so one failed command does not hide
+        # the results of the rest of the batch.
+        self.results = [CommandError(resp.message)
+                        if isinstance(resp, Error) else resp
+                        for resp in responses]
+        return self.results
+
+    def __len__(self):
+        return len(self._queue)
+
+
 def get_option_parser():
     parser = optparse.OptionParser()
     parser.add_option('-d', '--debug', action='store_true', dest='debug',
@@ -1166,12 +4225,69 @@ def get_option_parser():
     parser.add_option('-t', '--use-threads', action='store_false',
                       default=True, dest='use_gevent',
                       help='Use threads instead of gevent.')
+    parser.add_option('-a', '--asyncio', action='store_true',
+                      dest='use_asyncio',
+                      help='Use an asyncio event loop instead of gevent.')
+    parser.add_option('--uvloop', action='store_true', dest='use_uvloop',
+                      help='Run the asyncio server on uvloop.')
+    parser.add_option('--hz', default=10, dest='hz', type=int,
+                      help='Number of times per second to run background '
+                      'tasks such as removing expired keys (0 to disable).')
+    parser.add_option('--strict-clock', action='store_true',
+                      dest='strict_clock', help='Read the system clock for '
+                      'every expiry check instead of once per batch.')
+    parser.add_option('--appendonly', dest='appendonly', metavar='FILE',
+                      help='Log write commands to FILE, and replay it on '
+                      'startup.')
+    parser.add_option('--appendfsync', choices=AppendOnlyLog.policies,
+                      default='everysec', dest='appendfsync',
+                      help='When to fsync the append-only log: always, '
+                      'everysec (default) or no.')
+    parser.add_option('--save-file', dest='save_file', metavar='FILE',
+                      help='Save snapshots to FILE automatically, according '
+                      'to the save points.')
+    parser.add_option('--save', action='append', dest='save_points',
+                      metavar='SECONDS CHANGES', nargs=2, type=int,
+                      help='Save point: save after SECONDS if there have '
+                      'been at least CHANGES writes. May be repeated '
+                      '(default: 900 1, 300 10 and 60 10000).')
+    parser.add_option('--save-deltas', default=0, dest='max_deltas',
+                      metavar='N', type=int, help='Between full saves, save '
+                      'up to N deltas holding only the keys written since '
+                      'the previous save.')
+    parser.add_option('--save-partitions', default=1, dest='partitions',
+                      metavar='N', type=int, help='Split full snapshots '
+                      'over N files, which are restored in parallel.')
+    parser.add_option('--restore', dest='restore', metavar='FILE',
+                      help='Restore the keyspace from the snapshot FILE on '
+                      'startup.')
+    parser.add_option('--lazy-restore', action='store_true',
+                      dest='lazy_restore', help='Memory-map the snapshot '
+                      'and decode values on first access, or in the '
+                      'background, instead of loading it before starting.')
+    parser.add_option('--replicaof', dest='replicaof', metavar='HOST PORT',
+                      nargs=2, help='Run as a read-only replica of the '
+                      'server at HOST PORT.')
+    parser.add_option('--backlog-size', default=1024 * 1024,
+                      dest='backlog_size', metavar='BYTES', type=int,
+                      help='Keep the last BYTES of the replication stream, '
+                      'so replicas that lose the link briefly can resume '
+                      'without a full sync (default: 1MB).')
     parser.add_option('-H', '--host', default='127.0.0.1', dest='host',
                       help='Host to listen on.')
     parser.add_option('-m', '--max-clients', default=1024, dest='max_clients',
                       help='Maximum number of clients.', type=int)
+    parser.add_option('--max-pipeline', default=1000, dest='max_pipeline',
+                      help='Maximum number of pipelined responses sent in '
+                      'a single write.', type=int)
     parser.add_option('-p', '--port', default=31337, dest='port',
                       help='Port to listen on.', type=int)
+    parser.add_option('-w', '--workers', default=1, dest='workers',
+                      help='Number of worker processes, each owning part of '
+                      'the keyspace.', type=int)
+    parser.add_option('--worker-port', dest='worker_port', type=int,
+                      help='First of the private ports used by workers to '
+                      'forward commands to each other (default: port + 1).')
     parser.add_option('-l', '--log-file', dest='log_file', help='Log file.')
     parser.add_option('-x', '--extension', action='append', dest='extensions',
                       help='Import path for Python extension module(s).')
@@ -1208,10 +4324,73 @@ def load_extensions(server, extensions):
                 logger.info('Loaded %s extension.' % extension)
 
 
+def fork_workers(workers):
+    # Returns the worker index in each child. The parent waits for all of the
+    # workers to exit and does not return.
+    pids = []
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            return index
+        pids.append(pid)
+
+    while pids:
+        try:
+            pid, status = os.wait()
+        except KeyboardInterrupt:
+            continue
+        except OSError:
+            break
+        if pid in pids:
+            pids.remove(pid)
+    sys.exit(0)
+
+
 if __name__ == '__main__':
     options, args = get_option_parser().parse_args()
 
-    if options.use_gevent:
+    loop_factory = None
+    if options.use_uvloop:
+        options.use_asyncio = True
+        try:
+            import uvloop
+        except ImportError:
+            sys.stderr.write('uvloop is not installed.\n')
+            sys.stderr.flush()
+            sys.exit(1)
+        loop_factory = uvloop.new_event_loop
+
+    if options.workers > 1:
+        if not hasattr(os, 'fork'):
+            sys.stderr.write('Multiple workers are not supported on this '
+                             'platform.\n')
+            sys.exit(1)
+        elif options.use_asyncio:
+            sys.stderr.write('Multiple workers are not supported with '
+                             'asyncio.\n')
+            sys.exit(1)
+
+    replicaof = None
+    if options.replicaof:
+        if options.workers > 1:
+            sys.stderr.write('--replicaof cannot be combined with multiple '
+                             'workers.\n')
+            sys.exit(1)
+        host, port = options.replicaof
+        try:
+            replicaof = (host, int(port))
+        except ValueError:
+            sys.stderr.write('Invalid port "%s".\n' % port)
+            sys.exit(1)
+
+    if options.restore and options.appendonly:
+        sys.stderr.write('--restore cannot be combined with --appendonly, '
+                         'which is replayed on startup.\n')
+        sys.exit(1)
+
+    if options.use_asyncio:
+        options.use_gevent = False
+    elif options.use_gevent:
         try:
             from gevent import monkey; monkey.patch_all()
         except ImportError:
@@ -1222,18 +4401,55 @@ if __name__ == '__main__':
             sys.exit(1)
 
     configure_logger(options)
+    worker = None
+    if options.workers > 1:
+        worker = fork_workers(options.workers)
+
+    appendonly = options.appendonly
+    restore = options.restore
+    save_file = options.save_file
+    if worker is not None:
+        if appendonly:
+            appendonly = '%s.%s' % (appendonly, worker)
+        if restore:
+            restore = '%s.%s' % (restore, worker)
+        if save_file:
+            save_file = '%s.%s' % (save_file, worker)
+
     server = QueueServer(host=options.host, port=options.port,
                          max_clients=options.max_clients,
-                         use_gevent=options.use_gevent)
+                         use_gevent=options.use_gevent,
+                         max_pipeline=options.max_pipeline,
+                         use_asyncio=options.use_asyncio,
+                         loop_factory=loop_factory,
+                         reuse_port=worker is not None,
+                         hz=options.hz,
+                         strict_clock=options.strict_clock,
+                         appendonly=appendonly,
+                         appendfsync=options.appendfsync,
+                         snapshot_file=save_file,
+                         save_points=options.save_points,
+                         max_deltas=options.max_deltas,
+                         partitions=options.partitions,
+                         replicaof=replicaof,
+                         backlog_size=options.backlog_size)
+    if worker is not None:
+        worker_port = options.worker_port or options.port + 1
+        server.enable_sharding(worker, [
+            (options.host, worker_port + i) for i in range(options.workers)])
+    if restore and not server.restore_from_disk(restore,
+                                                lazy=options.lazy_restore):
+        logger.warning('Snapshot %s not found.' % restore)
     load_extensions(server, options.extensions or ())
-    print('\x1b[32m  .--.')
-    print(' /( \x1b[34m@\x1b[33m >\x1b[32m    ,-.  '
-          '\x1b[1;32mSimpleDB '
-          '\x1b[1;33m%s:%s\x1b[32m' % (options.host, options.port))
-    print('/ \' .\'--._/  /')
-    print(':   ,    , .\'')
-    print('\'. (___.\'_/')
-    print(' \x1b[33m((\x1b[32m-\x1b[33m((\x1b[32m-\'\'\x1b[0m')
+    if not worker:
+        print('\x1b[32m  .--.')
+        print(' /( \x1b[34m@\x1b[33m >\x1b[32m    ,-.  '
+              '\x1b[1;32mSimpleDB '
+              '\x1b[1;33m%s:%s\x1b[32m' % (options.host, options.port))
+        print('/ \' .\'--._/  /')
+        print(':   ,    , .\'')
+        print('\'. (___.\'_/')
+        print(' \x1b[33m((\x1b[32m-\x1b[33m((\x1b[32m-\'\'\x1b[0m')
     try:
         server.run()
     except KeyboardInterrupt:
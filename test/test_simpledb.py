@@ -0,0 +1,1081 @@
+from io import BytesIO
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from simpledb import CommandError
+from simpledb import Error
+from simpledb import IOV_MAX
+from simpledb import ProtocolHandler
+from simpledb import QueueServer
+from simpledb import ReplicationBacklog
+from simpledb import RequestParser
+from simpledb import TimingWheel
+
+
+def make_server(**kwargs):
+    # Commands run inline with the asyncio backend, and nothing listens
+    # until serve_forever() is called.
+    kwargs.setdefault('hz', 0)
+    return QueueServer(use_asyncio=True, **kwargs)
+
+
+def encode_requests(*requests):
+    protocol = ProtocolHandler()
+    buf = BytesIO()
+    for request in requests:
+        protocol._write(buf, request)
+    return buf.getvalue()
+
+
+def parse(data, parser=None, chunk_size=None):
+    # Feeds data in chunks, as it would be received from a connection.
+    parser = parser or RequestParser()
+    chunk_size = chunk_size or len(data) or 1
+    values = []
+    for i in range(0, len(data), chunk_size):
+        parser.feed(data[i:i + chunk_size])
+        value = parser.gets()
+        while value is not False:
+            values.append(value)
+            value = parser.gets()
+    return values
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Connection(object):
+    # Blocking client on a plain socket, whatever the server's backend.
+    def __init__(self, port, timeout=10):
+        self.sock = socket.create_connection(('127.0.0.1', port), timeout)
+        self.fh = self.sock.makefile('rb')
+        self.protocol = ProtocolHandler()
+
+    def execute(self, *requests):
+        self.sock.sendall(encode_requests(*requests))
+        return [self.protocol.handle_request(self.fh) for _ in requests]
+
+    def close(self):
+        self.fh.close()
+        self.sock.close()
+
+
+class Proxy(object):
+    # Forwards connections to a port, and can cut them to simulate a lost
+    # link. While it is down, new connections are closed on accept.
+    def __init__(self, port):
+        self.port = port
+        self.up = True
+        self._socks = []
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(16)
+        self.address = self.listener.getsockname()
+        self._start(self._accept)
+
+    def _start(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except socket.error:
+                return
+            if not self.up:
+                client.close()
+                continue
+            upstream = socket.create_connection(('127.0.0.1', self.port))
+            self._socks.extend((client, upstream))
+            self._start(self._pump, client, upstream)
+            self._start(self._pump, upstream, client)
+
+    def _pump(self, src, dest):
+        try:
+            data = src.recv(65536)
+            while data:
+                dest.sendall(data)
+                data = src.recv(65536)
+        except socket.error:
+            pass
+        for sock in (src, dest):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def cut(self):
+        self.up = False
+        socks, self._socks = self._socks, []
+        for sock in socks:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+
+    def close(self):
+        self.cut()
+        self.listener.close()
+
+
+def wait_for_children(server, timeout=10):
+    deadline = time.time() + timeout
+    while server._children and time.time() < deadline:
+        server.reap_children()
+        time.sleep(0.01)
+    assert not server._children
+
+
+def dump(server):
+    return (dict(server._kv.items()), dict(server._expiry.items()),
+            sorted(server._schedule))
+
+
+def sample_requests():
+    deadline = int(time.time() * 1000) + 3600000
+    return [
+        [b'MSET', dict((b'k%d' % i, b'v%d' % i) for i in range(100))],
+        [b'SET', b'n', 7],
+        [b'SET', b'big', b'x' * 5000],
+        [b'HMSET', b'h', {b'f1': b'v1', b'f2': 2}],
+        [b'RPUSH', b'q', b'a', b'b', b'c'],
+        [b'SADD', b's', b'm1', b'm2'],
+        [b'SETEX', b'e', b'expires', 3600],
+        [b'PEXPIREAT', b'k1', deadline],
+        [b'ADD', b'2030-01-01 00:00:00', b'job1'],
+        [b'ADD', b'2031-01-01 00:00:00', b'job2']]
+
+
+class BaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def path(self, name):
+        return os.path.join(self.dirname, name)
+
+    def run_requests(self, server, *requests):
+        # Error replies are returned rather than raised, so a mistyped
+        # command would otherwise go unnoticed.
+        responses, exc = server.run_requests(list(requests))
+        self.assertIsNone(exc)
+        for response in responses:
+            self.assertFalse(isinstance(response, Error), response)
+        return responses
+
+    def start_server(self, **kwargs):
+        # Serves from a background thread, with threads unless use_asyncio
+        # is given.
+        port = free_port()
+        kwargs.setdefault('use_gevent', False)
+        kwargs.setdefault('hz', 0)
+        server = QueueServer(port=port, **kwargs)
+        if server._use_asyncio:
+            thread = threading.Thread(target=server._server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            server._server._started.wait()
+            self.addCleanup(thread.join)
+        else:
+            server._server.start()
+            self.addCleanup(server._server.stream_server.server_close)
+        self.addCleanup(server._server.stop)
+        return server, port
+
+    def connect(self, port):
+        conn = Connection(port)
+        self.addCleanup(conn.close)
+        return conn
+
+    def populate(self, server):
+        # Every data type, with deadlines and scheduled items.
+        return self.run_requests(server, *sample_requests())
+
+
+class TestCommands(BaseTestCase):
+    def test_optional_arguments(self):
+        server = make_server()
+        self.run_requests(server, [b'RPUSH', b'q', b'a', b'b'],
+                          [b'HSET', b'h', b'f', 1], [b'SADD', b's', b'm'])
+        self.assertEqual(self.run_requests(
+            server, [b'LRANGE', b'q', 0], [b'LRANGE', b'q', 0, 1],
+            [b'HINCRBY', b'h', b'f'], [b'HINCRBY', b'h', b'f', 2],
+            [b'SPOP', b's', 1], [b'READ', b'2020-01-01 00:00:00']),
+            [[b'a', b'b'], [b'a'], 2, 4, [b'm'], []])
+
+        for request in ([b'LRANGE', b'q', 0, 1, 2],
+                        [b'HINCRBY', b'h', b'f', 1, 2],
+                        [b'SPOP', b's', 1, 2],
+                        [b'READ', b'2020-01-01 00:00:00', 1]):
+            (error,), _ = server.run_requests([request])
+            self.assertEqual(error.message, 'Wrong number of arguments '
+                             'for %s' % request[0].decode('ascii'))
+
+    def test_expiry_commands(self):
+        # -2 for a missing or expired key, -1 for a key without a deadline,
+        # otherwise the time left.
+        with mock.patch('time.time', return_value=1000.):
+            server = make_server()
+            self.run_requests(server, [b'SET', b'k', b'v'],
+                              [b'SET', b'p', b'v'])
+            self.assertEqual(self.run_requests(
+                server, [b'TTL', b'missing'], [b'PTTL', b'missing'],
+                [b'TTL', b'k'], [b'PTTL', b'k']), [-2, -2, -1, -1])
+
+            self.assertEqual(self.run_requests(
+                server, [b'PEXPIRE', b'k', 1500], [b'PTTL', b'k'],
+                [b'TTL', b'k'], [b'EXPIREAT', b'p', 1010], [b'TTL', b'p'],
+                [b'PTTL', b'p'], [b'PEXPIREAT', b'p', 1005000],
+                [b'PTTL', b'p'], [b'PEXPIRE', b'missing', 100],
+                [b'EXPIREAT', b'missing', 1010],
+                [b'PEXPIREAT', b'missing', 1005000]),
+                [1, 1500, 2, 1, 10, 10000, 1, 5000, 0, 0, 0])
+
+            self.assertEqual(self.run_requests(
+                server, [b'PERSIST', b'p'], [b'PERSIST', b'p'],
+                [b'PERSIST', b'missing'], [b'TTL', b'p'], [b'PTTL', b'p']),
+                [1, 0, 0, -1, -1])
+
+        with mock.patch('time.time', return_value=1002.):
+            self.assertEqual(self.run_requests(
+                server, [b'TTL', b'k'], [b'PTTL', b'k'], [b'PERSIST', b'k'],
+                [b'PEXPIRE', b'k', 100], [b'GET', b'k'], [b'TTL', b'p']),
+                [-2, -2, 0, 0, None, -1])
+
+    def check_clock(self, strict_clock):
+        # Returns the GET that follows a deadline passing in the same batch.
+        server, port = self.start_server(strict_clock=strict_clock)
+        server.add_command('SLEEP', lambda n: time.sleep(float(n)), 2)
+        conn = self.connect(port)
+        _, _, _, get = conn.execute(
+            [b'SET', b'k', b'v'], [b'PEXPIRE', b'k', 50], [b'SLEEP', b'0.1'],
+            [b'GET', b'k'])
+        self.assertEqual(conn.execute([b'GET', b'k']), [None])
+        return get
+
+    def test_cached_clock(self):
+        # The time is read once per batch, so the key is still visible to
+        # the rest of the batch.
+        self.assertEqual(self.check_clock(False), b'v')
+
+    def test_strict_clock(self):
+        self.assertEqual(self.check_clock(True), None)
+
+    def test_active_expiry(self):
+        # The tick removes keys whose deadline has passed, in batches,
+        # without them being read.
+        with mock.patch('time.time', return_value=1000.):
+            server = make_server(hz=10)
+            self.run_requests(
+                server,
+                [b'MSET', dict((b'k%d' % i, b'v') for i in range(1000))],
+                [b'SET', b'later', b'v'], [b'SET', b'never', b'v'],
+                [b'PEXPIRE', b'later', 5000],
+                *[[b'PEXPIRE', b'k%d' % i, 100] for i in range(1000)])
+            server.tick()
+            self.assertEqual(len(server._kv), 1002)
+
+        with mock.patch('time.time', return_value=1001.):
+            server.tick()
+            self.assertEqual(sorted(server._kv), [b'later', b'never'])
+            self.assertEqual(len(server._expiry), 1)
+            self.assertEqual(server.info()['expired_keys'], 1000)
+
+        with mock.patch('time.time', return_value=1005.):
+            server.tick()
+            self.assertEqual(list(server._kv), [b'never'])
+            self.assertEqual(len(server._expiry), 0)
+
+
+class TestThreadedServer(BaseTestCase):
+    def check_concurrent_reads(self, port):
+        # Replies are encoded before the executor runs the next command, so
+        # readers never see a container change size under them.
+        # Switching threads often makes the race likely to show up.
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-5)
+        members = set(b'm%d' % i for i in range(2000))
+        self.connect(port).execute([b'SADD', b's'] + sorted(members),
+                                   [b'HMSET', b'h', {b'f': b'v'}])
+        done = threading.Event()
+
+        def write():
+            # Separate batches, so that the sizes change between them.
+            conn = self.connect(port)
+            i = 0
+            while not done.is_set():
+                i += 1
+                conn.execute([b'SADD', b's', b'x%d' % i],
+                             [b'HSET', b'h', b'x%d' % i, i])
+                conn.execute([b'SREM', b's', b'x%d' % i],
+                             [b'HDEL', b'h', b'x%d' % i])
+
+        writers = [threading.Thread(target=write) for _ in range(4)]
+        for thread in writers:
+            thread.daemon = True
+            thread.start()
+        try:
+            conn = self.connect(port)
+            for _ in range(50):
+                smembers, hgetall, get = conn.execute(
+                    [b'SMEMBERS', b's'], [b'HGETALL', b'h'], [b'GET', b's'])
+                self.assertTrue(members <= smembers)
+                self.assertEqual(hgetall[b'f'], b'v')
+                self.assertTrue(members <= get)
+        finally:
+            done.set()
+            for thread in writers:
+                thread.join()
+
+    def test_commands_run_on_executor(self):
+        server, port = self.start_server()
+        threads = set()
+        state = {'n': 0}
+
+        def bump():
+            # Not atomic: only safe if one command runs at a time.
+            threads.add(threading.current_thread().ident)
+            n = state['n']
+            time.sleep(0)
+            state['n'] = n + 1
+            return state['n']
+
+        server.add_command('BUMP', bump, 1)
+
+        def run():
+            conn = self.connect(port)
+            for _ in range(100):
+                conn.execute([b'BUMP'], [b'INCR', b'n'])
+
+        clients = [threading.Thread(target=run) for _ in range(4)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        self.assertEqual(threads, set([server._executor._thread.ident]))
+        self.assertEqual(state['n'], 400)
+        self.assertEqual(self.connect(port).execute([b'GET', b'n']), [400])
+
+    def test_concurrent_reads(self):
+        server, port = self.start_server()
+        self.check_concurrent_reads(port)
+
+    def test_concurrent_reads_sharded(self):
+        # Commands run through the router, with only the local execution on
+        # the executor.
+        server, port = self.start_server()
+        server.enable_sharding(0, [('127.0.0.1', free_port())])
+        self.check_concurrent_reads(port)
+
+
+class TestPipelining(BaseTestCase):
+    def test_max_pipeline(self):
+        # Pipelined requests are run and answered in batches of at most
+        # max_pipeline, in order.
+        server, port = self.start_server(max_pipeline=10)
+        batches = []
+        run_and_encode = server.run_and_encode
+
+        def record(requests, local=False):
+            batches.append(len(requests))
+            return run_and_encode(requests, local)
+        server.run_and_encode = record
+
+        conn = self.connect(port)
+        self.assertEqual(conn.execute(*[[b'INCR', b'n']] * 25),
+                         list(range(1, 26)))
+        self.assertEqual(sum(batches), 25)
+        self.assertEqual(max(batches), 10)
+
+    def test_protocol_error(self):
+        # The requests before a protocol error are answered, then the error,
+        # and the connection is closed.
+        server, port = self.start_server()
+        conn = self.connect(port)
+        conn.sock.sendall(encode_requests([b'SET', b'k', b'v'],
+                                          [b'GET', b'k']) + b'$x\r\n')
+        read = conn.protocol.handle_request
+        self.assertEqual(read(conn.fh), 1)
+        self.assertEqual(read(conn.fh), b'v')
+        self.assertEqual(read(conn.fh),
+                         Error(b'Protocol error: invalid length or integer'))
+        self.assertEqual(conn.fh.read(), b'')
+
+
+class TestAsyncioServer(BaseTestCase):
+    def test_requests(self):
+        server, port = self.start_server(use_asyncio=True)
+        conn = self.connect(port)
+        other = self.connect(port)
+        big = b'x' * (1024 * 1024)
+
+        # A large bulk string arrives over many reads, into its buffer.
+        data = encode_requests([b'SET', b'big', big], [b'GET', b'big'])
+        for i in range(0, len(data), 100000):
+            conn.sock.sendall(data[i:i + 100000])
+            time.sleep(0.001)
+        read = conn.protocol.handle_request
+        self.assertEqual([read(conn.fh), read(conn.fh)], [1, big])
+
+        self.assertEqual(other.execute([b'GET', b'big'], [b'SADD', b's', b'm'],
+                                       [b'SMEMBERS', b's']),
+                         [big, 1, set([b'm'])])
+        self.assertEqual(conn.execute([b'QUIT']), [1])
+        self.assertEqual(conn.fh.read(), b'')
+        self.assertEqual(other.execute([b'INCR', b'n']), [1])
+
+    def test_slow_reader(self):
+        # Responses the client is not reading pause the connection, and
+        # nothing is lost once it catches up.
+        server, port = self.start_server(use_asyncio=True)
+        conn = self.connect(port)
+        big = b'y' * (1024 * 1024)
+        conn.execute([b'SET', b'big', big])
+        conn.sock.sendall(encode_requests(*[[b'GET', b'big']] * 30))
+        time.sleep(0.2)
+        read = conn.protocol.handle_request
+        for _ in range(30):
+            self.assertEqual(read(conn.fh), big)
+        self.assertEqual(conn.execute([b'EXISTS', b'big']), [1])
+
+
+class TestAppendOnlyLog(BaseTestCase):
+    def test_rewrite_in_pipeline(self):
+        # Commands earlier in the batch than REWRITELOG are in the child's
+        # snapshot, and must not be replayed again after it.
+        filename = self.path('log')
+        server = make_server(appendonly=filename)
+        self.run_requests(server, [b'SET', b'x', 1],
+                          [b'RPUSH', b'q', b'a'])
+        self.run_requests(server, [b'INCR', b'x'], [b'RPUSH', b'q', b'b'],
+                          [b'REWRITELOG'])
+        wait_for_children(server)
+        self.assertFalse(server._log.rewriting)
+        server._log.close()
+
+        replayed = make_server(appendonly=filename)
+        self.assertEqual(self.run_requests(
+            replayed, [b'GET', b'x'], [b'LRANGE', b'q', 0]),
+            [2, [b'a', b'b']])
+        replayed._log.close()
+
+    def test_restore_rewrites_log(self):
+        snapshot = self.path('snapshot')
+        other = make_server()
+        self.run_requests(other, [b'SET', b'y', b'restored'])
+        other.write_snapshot(snapshot)
+
+        filename = self.path('log')
+        server = make_server(appendonly=filename)
+        self.run_requests(server, [b'SET', b'x', b'old'])
+        server._log.start_rewrite()
+        self.run_requests(server, [b'RESTORE', snapshot])
+        self.assertTrue(server._rewrite_again)
+        server._finish_rewrite(filename + '.rewrite', False)
+        wait_for_children(server)
+        self.run_requests(server, [b'SET', b'z', b'new'])
+        server._log.close()
+
+        replayed = make_server(appendonly=filename)
+        self.assertEqual(self.run_requests(
+            replayed, [b'GET', b'x'], [b'GET', b'y'], [b'GET', b'z']),
+            [None, b'restored', b'new'])
+        replayed._log.close()
+
+    def test_restore_missing_file(self):
+        # Nothing is loaded, so neither the log nor the replicas start over.
+        server = make_server(appendonly=self.path('log'))
+        server._create_backlog()
+        repl_id = server._repl_id
+        self.assertEqual(self.run_requests(
+            server, [b'RESTORE', self.path('missing')],
+            [b'MERGE', self.path('missing')]), [False, False])
+        self.assertFalse(server._log.rewriting)
+        self.assertEqual(server._repl_id, repl_id)
+        self.assertEqual(server._dirty, 0)
+        server._log.close()
+
+    def test_replay(self):
+        filename = self.path('log')
+        server = make_server(appendonly=filename)
+        self.populate(server)
+        self.run_requests(server, [b'DELETE', b'k2'], [b'INCR', b'n'],
+                          [b'LPOP', b'q'], [b'SREM', b's', b'm1'],
+                          [b'HDEL', b'h', b'f1'], [b'PERSIST', b'e'],
+                          [b'READ', b'2030-06-01 00:00:00'])
+        server._log.close()
+
+        replayed = make_server(appendonly=filename)
+        self.assertEqual(dump(replayed), dump(server))
+        replayed._log.close()
+
+    def test_replay_rewritten_log(self):
+        filename = self.path('log')
+        server = make_server(appendonly=filename)
+        self.populate(server)
+        self.run_requests(server, [b'DELETE', b'k2'], [b'REWRITELOG'])
+        self.run_requests(server, [b'INCR', b'n'], [b'RPUSH', b'q', b'd'])
+        wait_for_children(server)
+        self.run_requests(server, [b'SADD', b's', b'm3'],
+                          [b'READ', b'2030-06-01 00:00:00'])
+        server._log.close()
+
+        replayed = make_server(appendonly=filename)
+        self.assertEqual(dump(replayed), dump(server))
+        replayed._log.close()
+
+
+class TestSnapshots(BaseTestCase):
+    def test_bgsave(self):
+        # The child saves the keyspace as it was when BGSAVE ran.
+        filename = self.path('snapshot')
+        server = make_server()
+        self.populate(server)
+        expected = dump(server)
+        self.assertEqual(self.run_requests(server, [b'BGSAVE', filename]),
+                         [1])
+        self.run_requests(server, [b'SET', b'after', b'bgsave'])
+        wait_for_children(server)
+        self.assertEqual(server._last_save_status, 'ok')
+
+        restored = make_server()
+        self.assertTrue(restored.restore_from_disk(filename))
+        self.assertEqual(dump(restored), expected)
+
+    def test_round_trip(self):
+        filename = self.path('snapshot')
+        server = make_server()
+        self.populate(server)
+        server.write_snapshot(filename)
+
+        restored = make_server()
+        self.assertTrue(restored.restore_from_disk(filename))
+        self.assertEqual(dump(restored), dump(server))
+
+    def test_lazy_round_trip(self):
+        # Values are decoded as they are read, or when the keyspace is
+        # iterated.
+        filename = self.path('snapshot')
+        server = make_server()
+        self.populate(server)
+        server.write_snapshot(filename)
+
+        restored = make_server()
+        self.assertTrue(restored.restore_from_disk(filename, lazy=True))
+        self.assertEqual(self.run_requests(
+            restored, [b'GET', b'big'], [b'HGET', b'h', b'f2'],
+            [b'LRANGE', b'q', 0]), [b'x' * 5000, 2, [b'a', b'b', b'c']])
+        self.assertEqual(dump(restored), dump(server))
+
+    def test_lazy_keyspace_is_unmapped(self):
+        # The snapshots of a lazy keyspace are unmapped once it is replaced,
+        # even before all of its values have been decoded.
+        filename = self.path('snapshot')
+        server = make_server(partitions=2, hz=10)
+        self.populate(server)
+        server.write_snapshot(filename, generation=1)
+
+        def snapshots():
+            kv = server._kv
+            self.assertEqual(len(kv.snapshots), 3)
+            return [snapshot._mmap for snapshot in kv.snapshots]
+
+        server.restore_from_disk(filename, lazy=True)
+        maps = snapshots()
+        self.run_requests(server, [b'RESTORE', filename])
+        self.assertTrue(all(mm.closed for mm in maps))
+        self.assertEqual(self.run_requests(server, [b'GET', b'big']),
+                         [b'x' * 5000])
+
+        server.restore_from_disk(filename, lazy=True)
+        maps = snapshots()
+        self.run_requests(server, [b'FLUSH'])
+        self.assertTrue(all(mm.closed for mm in maps))
+        self.assertEqual(server._kv, {})
+
+        server.restore_from_disk(filename, lazy=True)
+        maps = snapshots()
+        server.warm_up()
+        self.assertTrue(server._kv.__class__ is dict)
+        self.assertTrue(all(mm.closed for mm in maps))
+
+    def test_deadlines(self):
+        # Deadlines are restored as saved, and keys whose deadline passed in
+        # the meantime are left out.
+        filename = self.path('snapshot')
+        now = int(time.time() * 1000)
+        server = make_server()
+        self.run_requests(server, [b'SET', b'soon', b'v'],
+                          [b'SET', b'later', b'v'], [b'SET', b'never', b'v'],
+                          [b'PEXPIREAT', b'soon', now + 100],
+                          [b'PEXPIREAT', b'later', now + 3600000])
+        server.write_snapshot(filename)
+        time.sleep(0.2)
+
+        restored = make_server()
+        self.assertTrue(restored.restore_from_disk(filename))
+        self.assertEqual(sorted(restored._kv), [b'later', b'never'])
+        self.assertEqual(dict(restored._expiry.items()),
+                         {b'later': now + 3600000})
+
+    def test_save_points(self):
+        # Saves after 60 seconds with 1 change, or at once with 3.
+        filename = self.path('snapshot')
+        server = make_server(snapshot_file=filename,
+                             save_points=[(60, 1), (0, 3)])
+        self.run_requests(server, [b'SET', b'a', b'1'])
+        server.check_save_points()
+        self.assertIsNone(server._bgsave_started)
+        self.run_requests(server, [b'SET', b'b', b'2'],
+                          [b'SET', b'c', b'3'])
+        server.check_save_points()
+        self.assertIsNotNone(server._bgsave_started)
+        wait_for_children(server)
+        self.assertEqual(server._dirty, 0)
+        self.assertTrue(os.path.exists(filename))
+
+        self.run_requests(server, [b'SET', b'd', b'4'])
+        server.check_save_points()
+        self.assertIsNone(server._bgsave_started)
+        server._saved_at -= 60
+        server.check_save_points()
+        self.assertIsNotNone(server._bgsave_started)
+        wait_for_children(server)
+
+        restored = make_server()
+        restored.restore_from_disk(filename)
+        self.assertEqual(sorted(restored._kv), [b'a', b'b', b'c', b'd'])
+
+    def test_delta_round_trip(self):
+        filename = self.path('snapshot')
+        server = make_server(snapshot_file=filename, max_deltas=3)
+        self.populate(server)
+        server.save_snapshot_file()
+        wait_for_children(server)
+
+        # Changes, deletions and new keys, in two deltas.
+        self.run_requests(server, [b'DELETE', b'k2'], [b'SET', b'k3', b'new'],
+                          [b'SET', b'k100', b'added'], [b'INCR', b'n'],
+                          [b'EXPIRE', b'k4', 3600], [b'PERSIST', b'e'])
+        server.save_snapshot_file()
+        wait_for_children(server)
+        self.run_requests(server, [b'SET', b'k2', b'back'],
+                          [b'MDELETE', b'k3', b'k100'],
+                          [b'RPUSH', b'q', b'd'], [b'SREM', b's', b'm1'],
+                          [b'READ', b'2030-06-01 00:00:00'])
+        server.save_snapshot_file()
+        wait_for_children(server)
+        self.assertEqual(server._deltas, 2)
+
+        restored = make_server(snapshot_file=filename, max_deltas=3)
+        self.assertTrue(restored.restore_from_disk(filename))
+        self.assertEqual(dump(restored), dump(server))
+
+    def test_rejected_bgsave_keeps_dirty_keys(self):
+        filename = self.path('snapshot')
+        server = make_server(snapshot_file=filename, max_deltas=3)
+        server.save_snapshot_file()
+        wait_for_children(server)
+        self.run_requests(server, [b'SET', b'k', b'v'])
+
+        server._bgsave_started = time.time()  # Another save in progress.
+        (error,), _ = server.run_requests([[b'BGSAVE', filename]])
+        self.assertEqual(error.message, 'Background save already in '
+                         'progress.')
+        self.assertEqual(server._dirty_keys, set([b'k']))
+        server._bgsave_started = None
+
+        server.save_snapshot_file()
+        wait_for_children(server)
+        self.assertEqual(server._deltas, 1)
+        restored = make_server(snapshot_file=filename, max_deltas=3)
+        restored.restore_from_disk(filename)
+        self.assertEqual(self.run_requests(restored, [b'GET', b'k']), [b'v'])
+
+    def test_bytes_filenames(self):
+        # Client.save(b'/path') sends the filename as bytes.
+        filename = self.path('snapshot').encode('utf-8')
+        server = make_server(partitions=2)
+        self.run_requests(server, [b'SET', b'k', b'v'])
+        self.assertEqual(self.run_requests(
+            server, [b'SAVE', filename], [b'BGSAVE', filename]), [1, 1])
+        wait_for_children(server)
+        self.assertEqual(server._last_save_status, 'ok')
+
+        restored = make_server()
+        self.assertEqual(self.run_requests(
+            restored, [b'RESTORE', filename], [b'MERGE', filename],
+            [b'GET', b'k']), [True, True, b'v'])
+
+    def test_backups_leave_changes_unsaved(self):
+        filename = self.path('snapshot')
+        server = make_server(snapshot_file=filename)
+        self.run_requests(server, [b'SET', b'k', b'v'],
+                          [b'SAVE', self.path('backup')],
+                          [b'BGSAVE', self.path('backup2')])
+        wait_for_children(server)
+        self.assertEqual(server._last_save_status, 'ok')
+        self.assertEqual(server._dirty, 1)
+        self.run_requests(server, [b'SAVE', filename])
+        self.assertEqual(server._dirty, 0)
+
+    def test_partitioned_round_trip(self):
+        filename = self.path('snapshot')
+        server = make_server(partitions=3)
+        self.populate(server)
+        server.write_snapshot(filename, generation=1)
+        self.assertEqual(len(os.listdir(self.dirname)), 4)
+
+        restored = make_server()
+        self.assertTrue(restored.restore_from_disk(filename))
+        self.assertEqual(dump(restored), dump(server))
+
+    def test_partitions_of_saves_in_one_millisecond(self):
+        # Each save writes partitions of its own, even when the clock has
+        # not moved, or the server was restarted after it went back.
+        filename = self.path('snapshot')
+        now = time.time()
+        saved = set()
+        with mock.patch('time.time', return_value=now):
+            for i in range(3):
+                server = make_server(partitions=2)
+                for value in (b'a', b'b'):
+                    self.run_requests(server, [b'SET', b'k', value])
+                    self.run_requests(server, [b'SAVE', filename],
+                                      [b'SET', b'k', b'x'],
+                                      [b'BGSAVE', filename + '.bg'],
+                                      [b'SET', b'k', value])
+                    wait_for_children(server)
+                    names = set(os.listdir(self.dirname))
+                    self.assertFalse(names & saved)
+                    saved.update(name for name in names
+                                 if '.part' in name)
+
+                    restored = make_server()
+                    restored.restore_from_disk(filename)
+                    self.assertEqual(self.run_requests(
+                        restored, [b'GET', b'k']), [value])
+
+    def test_partitioned_base_size(self):
+        # Deltas are compared with the size of the base, partitions included.
+        filename = self.path('snapshot')
+        server = make_server(snapshot_file=filename, max_deltas=3,
+                             partitions=2)
+        self.run_requests(server, [b'MSET', dict(
+            (b'k%d' % i, b'v' * 100) for i in range(1000))])
+        server.save_snapshot_file()
+        wait_for_children(server)
+        size = sum(os.path.getsize(self.path(name))
+                   for name in os.listdir(self.dirname))
+        self.assertTrue(size > 100000)
+        self.assertEqual(server._base_size, size)
+
+        restored = make_server(snapshot_file=filename, max_deltas=3)
+        restored.restore_from_disk(filename)
+        self.assertEqual(restored._base_size, size)
+
+
+class TestShardRouter(BaseTestCase):
+    def test_keyless_commands_are_executed(self):
+        # Commands without keys still go through the executor and
+        # execute_command(), so admin writes are counted and handled.
+        snapshot = self.path('snapshot')
+        server = QueueServer(use_gevent=False, hz=0, port=31700,
+                             appendonly=self.path('log'))
+        server.enable_sharding(0, [('127.0.0.1', 31701)])
+        self.run_requests(server, [b'SET', b'k', b'v'])
+        self.assertEqual(self.run_requests(server, [b'SAVE', snapshot]),
+                         [1])
+        dirty = server._dirty
+        self.assertEqual(self.run_requests(server, [b'RESTORE', snapshot]),
+                         [True])
+        self.assertEqual(server._dirty, dirty + 1)
+        self.assertTrue(server._log.rewriting)
+        wait_for_children(server)
+        server._log.close()
+
+
+class ShortWriteSocket(object):
+    # Accepts at most a few bytes per sendmsg(), like a full socket buffer.
+    def __init__(self, seed=0):
+        self.rng = random.Random(seed)
+        self.data = bytearray()
+        self.calls = []
+
+    def sendmsg(self, buffers):
+        self.calls.append(len(buffers))
+        joined = b''.join(bytes(buf) for buf in buffers)
+        nbytes = min(len(joined), self.rng.choice((1, 7, 100, 20000)))
+        self.data += joined[:nbytes]
+        return nbytes
+
+    def sendall(self, data):
+        self.data += data
+
+
+class TestResponseBuffer(unittest.TestCase):
+    def test_short_writes(self):
+        # Sending resumes in the middle of a segment, large or small.
+        responses = [b'x' * 50000, 1, [b'a' * 20000, b'small', None],
+                     bytearray(b'y' * 30000), {b'k': b'z' * 16384}, b'end']
+        expected = encode_requests(*responses)
+        for seed in range(10):
+            sock = ShortWriteSocket(seed)
+            ProtocolHandler().send_responses(sock, responses)
+            self.assertEqual(bytes(sock.data), expected)
+            self.assertTrue(len(sock.calls) > 1)
+
+    def test_more_segments_than_iov_max(self):
+        responses = [b'%d' % i for i in range(IOV_MAX * 2 + 10)]
+        sock = ShortWriteSocket()
+        ProtocolHandler(zero_copy_threshold=1).send_responses(sock,
+                                                              responses)
+        self.assertEqual(bytes(sock.data), encode_requests(*responses))
+        self.assertTrue(max(sock.calls) <= IOV_MAX)
+
+
+class TestRequestParser(BaseTestCase):
+    def test_large_hashed_arguments(self):
+        # Large bulk strings are received into bytearrays, but keys, hash
+        # fields and set members have to be hashable.
+        big = b'x' * 200000
+        requests = parse(encode_requests(
+            [b'SADD', b's', big],
+            [b'HSET', b'h', big, b'v'],
+            [b'MSET', {big: b'v'}],
+            [b'SET', big, big],
+            [b'SISMEMBER', b's', big],
+            [b'HGET', b'h', big],
+            [b'GET', big]), chunk_size=65536)
+        self.assertTrue(isinstance(requests[-1][1], bytearray))
+        server = make_server()
+        self.assertEqual(self.run_requests(server, *requests),
+                         [1, 1, 1, 1, 1, b'v', big])
+
+    def test_max_bulk_length(self):
+        parser = RequestParser(max_bulk_length=1024)
+        self.assertEqual(parse(b'*2\r\n$3\r\nGET\r\n$1024\r\n', parser),
+                         [])
+        self.assertRaises(CommandError, parse,
+                          b'*2\r\n$3\r\nGET\r\n$1025\r\n',
+                          RequestParser(max_bulk_length=1024))
+        self.assertRaises(CommandError, parse, b'$999999999999\r\n')
+
+    def test_chunk_boundaries(self):
+        # Requests split at any point parse the same as when fed whole.
+        requests = [
+            [b'SET', b'k', b'v'],
+            [b'MSET', {b'a': b'1', b'b': 2}],
+            [b'SET', b'big', b'x' * 100000],
+            [b'SADD', b's', set([b'm1', b'm2'])],
+            [b'SET', b'u', u'\u2603'],
+            [b'RPUSH', b'q', [b'a', [1, 2.5, None]], b''],
+            [b'SET', b'k2', b'y' * 70000],
+            [b'GET', b'k']]
+        data = encode_requests(*requests)
+        expected = parse(data)
+        self.assertEqual(len(expected), len(requests))
+        for chunk_size in (1, 2, 3, 7, 100, 4096, 65536, 65537):
+            self.assertEqual(parse(data, chunk_size=chunk_size), expected)
+
+        rng = random.Random(0)
+        for _ in range(20):
+            parser = RequestParser()
+            values = []
+            pos = 0
+            while pos < len(data):
+                n = rng.choice((1, rng.randint(1, 100),
+                                rng.randint(1, 100000)))
+                parser.feed(data[pos:pos + n])
+                pos += n
+                value = parser.gets()
+                while value is not False:
+                    values.append(value)
+                    value = parser.gets()
+            self.assertEqual(values, expected)
+
+
+class TestTimingWheel(unittest.TestCase):
+    def check(self, levels, max_delta, steps=5000, seed=0):
+        # Compared with a dict of deadlines, using small wheels so that
+        # cascading and deadlines beyond the span are exercised.
+        rng = random.Random(seed)
+        now = rng.randint(0, 1 << 20)
+        wheel = TimingWheel(now, levels)
+        model = {}
+        for _ in range(steps):
+            op = rng.random()
+            key = rng.randint(0, 200)
+            if op < 0.4:
+                deadline = now + rng.randint(-10, max_delta)
+                wheel.add(key, deadline)
+                model[key] = deadline
+            elif op < 0.5:
+                self.assertEqual(wheel.remove(key), key in model)
+                model.pop(key, None)
+            elif op < 0.55:
+                items = [(rng.randint(0, 200),
+                          now + rng.randint(-10, max_delta))
+                         for _ in range(rng.randint(0, 10))]
+                wheel.update(items)
+                model.update(items)
+            else:
+                now += rng.choice((0, 1, rng.randint(0, 100),
+                                   rng.randint(0, max_delta)))
+                limit = rng.choice((None, None, 0, 1, 5))
+                expired = wheel.pop_expired(now, limit)
+                due = [k for k, deadline in model.items()
+                       if deadline <= now]
+                if limit is None:
+                    self.assertEqual(sorted(expired), sorted(due))
+                else:
+                    self.assertEqual(len(expired), min(limit, len(due)))
+                    self.assertTrue(set(expired) <= set(due))
+                for k in expired:
+                    del model[k]
+            self.assertEqual(len(wheel), len(model))
+            self.assertEqual(wheel.get(key), model.get(key))
+            self.assertEqual(key in wheel, key in model)
+        self.assertEqual(dict(wheel.items()), model)
+
+    def test_small_wheel(self):
+        self.check((2, 2, 2), 200)
+
+    def test_deadlines_beyond_span(self):
+        self.check((3, 2), 1000, seed=1)
+
+    def test_default_levels(self):
+        self.check((8, 6, 6, 6, 6), 1 << 34, seed=2)
+        self.check((8, 6, 6, 6, 6), 100000, seed=3)
+
+
+class TestReplication(BaseTestCase):
+    # Primaries and replicas run as separate processes, as they would be
+    # deployed.
+    def spawn(self, *args):
+        port = free_port()
+        log = open(self.path('server-%s.log' % port), 'wb')
+        self.addCleanup(log.close)
+        process = subprocess.Popen(
+            [sys.executable, 'simpledb.py', '-p', str(port)] + list(args),
+            cwd=os.path.dirname(os.path.abspath(__file__)), stdout=log,
+            stderr=subprocess.STDOUT)
+        self.addCleanup(process.wait)
+        self.addCleanup(process.kill)
+        deadline = time.time() + 10
+        while True:
+            try:
+                conn = Connection(port)
+            except socket.error:
+                self.assertIsNone(process.poll())
+                self.assertTrue(time.time() < deadline)
+                time.sleep(0.05)
+            else:
+                self.addCleanup(conn.close)
+                return port, conn
+
+    def wait_for(self, conn, request, expected, timeout=10):
+        deadline = time.time() + timeout
+        while conn.execute(request) != [expected]:
+            self.assertTrue(time.time() < deadline,
+                            '%r never returned %r' % (request, expected))
+            time.sleep(0.05)
+
+    def info(self, conn):
+        return conn.execute([b'INFO'])[0]
+
+    def test_gevent_primary(self):
+        # Under gevent, waiting for data to send the replica must not block
+        # the other clients.
+        port, primary = self.spawn()
+        _, replica = self.spawn('-t', '--replicaof', '127.0.0.1', str(port))
+        primary.execute([b'SET', b'k1', b'v1'])
+        self.wait_for(replica, [b'GET', b'k1'], b'v1')
+        self.assertEqual(self.info(primary)['connected_replicas'], 1)
+
+        other = Connection(port)
+        self.addCleanup(other.close)
+        self.assertEqual(other.execute([b'SET', b'k2', b'v2'],
+                                       [b'SADD', b's', b'm']), [1, 1])
+        self.wait_for(replica, [b'SMEMBERS', b's'], set([b'm']))
+        self.assertEqual(replica.execute([b'GET', b'k2']), [b'v2'])
+
+    def test_partial_resync(self):
+        # A gevent replica of an asyncio primary, over a link that is lost
+        # and resumed from the backlog.
+        port, primary = self.spawn('-a')
+        proxy = Proxy(port)
+        self.addCleanup(proxy.close)
+        _, replica = self.spawn('--replicaof', '127.0.0.1',
+                                str(proxy.address[1]))
+        primary.execute([b'MSET', dict((b'k%d' % i, b'v%d' % i)
+                                       for i in range(100))])
+        self.wait_for(replica, [b'GET', b'k99'], b'v99')
+
+        # Written while the link is down, so only the backlog has them.
+        proxy.cut()
+        deadline = time.time() + 10
+        while self.info(replica)['primary_link_up']:
+            self.assertTrue(time.time() < deadline)
+            time.sleep(0.05)
+        primary.execute([b'SET', b'k0', b'changed'], [b'DELETE', b'k1'],
+                        [b'RPUSH', b'q', b'a', b'b'])
+        self.assertEqual(replica.execute([b'GET', b'k0']), [b'v0'])
+
+        proxy.up = True
+        self.wait_for(replica, [b'LRANGE', b'q', 0], [b'a', b'b'])
+        self.assertEqual(replica.execute([b'GET', b'k0'], [b'GET', b'k1']),
+                         [b'changed', None])
+        info = self.info(primary)
+        self.assertEqual((info['full_syncs'], info['partial_syncs']), (1, 1))
+        self.assertEqual(self.info(replica)['replication_offset'],
+                         info['replication_offset'])
+
+
+class TestReplicationBacklog(unittest.TestCase):
+    def test_read_from(self):
+        rng = random.Random(0)
+        for size in (1, 7, 64, 1000):
+            start = rng.randint(0, 1 << 40)
+            backlog = ReplicationBacklog(size, start)
+            stream = b''
+            for _ in range(300):
+                data = bytes(bytearray(rng.randint(0, 255) for _ in range(
+                    rng.choice((0, 1, rng.randint(1, size * 2))))))
+                backlog.append(data)
+                stream += data
+                end = start + len(stream)
+                self.assertEqual(backlog.offset, end)
+                self.assertEqual(len(backlog), min(len(stream), size))
+                for offset in (end, end - len(backlog),
+                               rng.randint(end - len(backlog), end)):
+                    self.assertEqual(backlog.read_from(offset),
+                                     stream[offset - start:])
+                self.assertIsNone(backlog.read_from(end + 1))
+                self.assertIsNone(backlog.read_from(end - len(backlog) - 1))
+
+
+if __name__ == '__main__':
+    unittest.main()